@@ -1,95 +1,263 @@
-from Queue import Queue
-from threading import Thread
+from Queue import PriorityQueue
+from threading import Thread, Lock, Event, local
+import itertools
 import logging
+from display.timing import monotonic, TimingStats
+
+_current = local()
+
+
+def current_future():
+    '''
+    :return: The AsynchFuture of the task running in the calling thread, if any
+    '''
+    return getattr(_current, 'future', None)
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class AsynchFuture(object):
+    '''
+    The result of a submitted task.
+    A pending task is cancelled at once. A running task cannot be stopped
+    from outside, so cancelling it only sets cancel_requested. Tasks that
+    can be superseded check it and give up early.
+    '''
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    CANCELLED = 'cancelled'
+    FINISHED = 'finished'
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.PENDING
+        self.cancel_requested = Event()
+        self._done = Event()
+        self._lock = Lock()
+        self._result = None
+        self._error = None
+
+    def cancel(self):
+        '''
+        :return: False if the task had already finished
+        '''
+        with self._lock:
+            if self.state in (self.FINISHED, self.CANCELLED):
+                return False
+            self.cancel_requested.set()
+            if self.state == self.PENDING:
+                self.state = self.CANCELLED
+                self._error = TaskCancelled(self.name)
+                self._done.set()
+            return True
+
+    def cancelled(self):
+        return self.state == self.CANCELLED
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''
+        Waits for the task to finish.
+        :return: The return value of the task
+        :raises: The exception raised by the task, TaskCancelled if the task
+            was cancelled or Exception if the task did not finish in time
+        '''
+        if not self._done.wait(timeout):
+            raise Exception('Task {0} did not finish in {1}s'.format(self.name, timeout))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def set_running(self):
+        '''
+        :return: False if the task was cancelled before it started
+        '''
+        with self._lock:
+            if self.state != self.PENDING:
+                return False
+            self.state = self.RUNNING
+            return True
+
+    def set_finished(self, result, error):
+        with self._lock:
+            if error is not None and self.cancel_requested.is_set():
+                # The task gave up because it was cancelled
+                self.state = self.CANCELLED
+                error = TaskCancelled(self.name)
+            else:
+                self.state = self.FINISHED
+            self._result = result
+            self._error = error
+            self._done.set()
+        return error
 
 
 class AsynchTask(object):
     '''
     A simple container for functions needed to run a task
     '''
-    def __init__(self, work_func, on_success, on_error, params):
+    def __init__(self, work_func, on_success, on_error, params, name, key):
         self.work_func = work_func
         self.on_success = on_success
         self.on_error = on_error
         self.params = params
+        self.name = name
+        self.key = key
+        self.future = AsynchFuture(name)
+        self.submit_time = monotonic()
 
 
 class AsynchExecutor(object):
     '''
-    Executes tasks submitted to a FIFO queue using a daemon thread.
-    Calls to submit() block until there is space in the queue.
-    The daemon thread will block if the queue is empty.
+    Executes submitted tasks using a pool of daemon threads.
+    Tasks with a smaller priority number run first and tasks of the same
+    priority in the order they were submitted, so a playlist poll does not
+    wait behind downloads and housekeeping. submit() never blocks.
+    The time tasks wait in the queue and the time they run are measured per
+    task name.
     '''
 
     LOG = logging.getLogger(__name__)
 
-    def __init__(self, queue_size=10):
-        self.LOG.debug('Initializing AsynchExecutor')
+    # Priorities
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+    SHUTDOWN = -1
+
+    def __init__(self, worker_count=2):
+        self.LOG.debug('Initializing AsynchExecutor with %s workers', worker_count)
         self.running = False
-        self.task_queue = Queue(queue_size)  # FIFO queue
-
-        def consume_task_queue(executor):
-            while executor.is_running():
-                task = executor.task_queue.get()
-                self.LOG.debug('Running task %s' % task)
-                if task == 'SHUTDOWN':
-                    break
-                try:
-                    retval, retval2, retval3 = task.work_func(*task.params)
-                    self.LOG.debug('AsynchTask finished with retval %s' % retval)
-                    task.on_success(retval, retval2, retval3)
-                except Exception as e:
-                    task.on_error(e)
-        self.work_thread = Thread(target=consume_task_queue, args=(self,))
-        self.work_thread.daemon = True
+        self.task_queue = PriorityQueue()
+        self._sequence = itertools.count()
+        self._lock = Lock()
+        # Pending tasks by key, for coalescing identical tasks
+        self._pending = {}
+        # (queue wait, run time) TimingStats by task name
+        self._stats = {}
+        self.workers = [Thread(target=self.consume_task_queue) for _ in xrange(max(1, worker_count))]
+        for worker in self.workers:
+            worker.daemon = True
+
+    def consume_task_queue(self):
+        while self.is_running():
+            _, _, task = self.task_queue.get()
+            if task is None:
+                break
+            self.run_task(task)
+
+    def run_task(self, task):
+        with self._lock:
+            if task.key is not None and self._pending.get(task.key) is task:
+                del self._pending[task.key]
+        future = task.future
+        if not future.set_running():
+            self.LOG.debug('Skipping cancelled task %s', task.name)
+            self.call(task.on_error, TaskCancelled(task.name))
+            return
+        start_time = monotonic()
+        self.LOG.debug('Running task %s', task.name)
+        result = None
+        error = None
+        _current.future = future
+        try:
+            result = task.work_func(*task.params)
+        except Exception as e:
+            error = e
+        finally:
+            _current.future = None
+        self.record(task.name, start_time - task.submit_time, monotonic() - start_time)
+        error = future.set_finished(result, error)
+        if error is None:
+            self.LOG.debug('AsynchTask %s finished', task.name)
+            self.call(task.on_success, result)
+        else:
+            self.call(task.on_error, error)
+
+    def call(self, callback, param):
+        try:
+            callback(param)
+        except Exception:
+            self.LOG.exception('Task callback failed')
+
+    def record(self, name, queue_wait, run_time):
+        with self._lock:
+            if name not in self._stats:
+                self._stats[name] = (TimingStats(), TimingStats())
+            queue_wait_stats, run_time_stats = self._stats[name]
+            queue_wait_stats.record(queue_wait)
+            run_time_stats.record(run_time)
 
     def start(self):
-        ''' Starts the daemon thread '''
+        ''' Starts the worker threads '''
         self.running = True
-        self.work_thread.start()
-        self.LOG.debug('Started AsynchExecutor worker thread')
+        for worker in self.workers:
+            worker.start()
+        self.LOG.debug('Started AsynchExecutor worker threads')
 
     def shutdown(self):
-        ''' Stops the worker thread and joins with it '''
-        self.LOG.debug('Stopping AsynchExecutor worker thread')
+        ''' Stops the worker threads after their current tasks and joins with them '''
+        self.LOG.debug('Stopping AsynchExecutor worker threads')
         self.running = False
-        self.task_queue.put('SHUTDOWN')
-        self.work_thread.join()
-        self.LOG.debug('AsynchExecutor worker thread stopped')
+        for _ in self.workers:
+            self.task_queue.put((self.SHUTDOWN, next(self._sequence), None))
+        for worker in self.workers:
+            worker.join()
+        self.LOG.debug('AsynchExecutor worker threads stopped')
 
     def is_running(self):
         return self.running
 
     def submit(self, work_func, **kwargs):
         '''
-        Uses the functions passed as parameters to create and
-        AsynchTask and places it in the task queue.
-        This operation blocks if the task queue is full.
+        Uses the functions passed as parameters to create an AsynchTask
+        and places it in the task queue.
+        on_success is called with the return value of work_func and on_error
+        with the exception it raised, TaskCancelled if it was cancelled.
+        :param priority: HIGH, NORMAL (default) or LOW
+        :param key: If a task with the same key is still waiting in the
+            queue, no new task is added and the future of the waiting one is
+            returned
+        :param name: The name of the task in the stats, the name of
+            work_func by default
+        :return: An AsynchFuture
         '''
         def no_action(param):
             pass
 
-        if 'on_success' not in kwargs:
-            on_success = no_action
-        else:
-            on_success = kwargs['on_success']
-        if 'on_error' not in kwargs:
-            on_error = no_action
-        else:
-            on_error = kwargs['on_error']
-        if 'params' not in kwargs:
-            params = ()
-        else:
-            params = kwargs['params']
+        on_success = kwargs.get('on_success', no_action)
+        on_error = kwargs.get('on_error', no_action)
+        params = kwargs.get('params', ())
+        priority = kwargs.get('priority', self.NORMAL)
+        key = kwargs.get('key')
+        name = kwargs.get('name', work_func.__name__)
 
-        task = AsynchTask(work_func, on_success, on_error, params)
-        self.LOG.debug('Submitting new AsynchTask to FIFO queue...')
-        self.task_queue.put(task)
-        self.LOG.debug('AsynchTask accepted into FIFO queue')
+        with self._lock:
+            if key is not None:
+                pending_task = self._pending.get(key)
+                if pending_task is not None and not pending_task.future.cancelled():
+                    self.LOG.debug('Task %s is already waiting', name)
+                    return pending_task.future
+            task = AsynchTask(work_func, on_success, on_error, params, name, key)
+            if key is not None:
+                self._pending[key] = task
+        self.task_queue.put((priority, next(self._sequence), task))
+        self.LOG.debug('AsynchTask %s accepted into queue', name)
+        return task.future
 
-    def is_full(self):
+    def get_stats(self):
         '''
-        If the task queue is full, calling submit() will block.
-        Use this to check if submitting will block.
+        :return: The number of waiting tasks and the queue wait and run time
+            of the tasks by name
         '''
-        return self.task_queue.full()
+        with self._lock:
+            tasks = dict(
+                (name, {'queue_wait': queue_wait.get_stats(), 'run_time': run_time.get_stats()})
+                for name, (queue_wait, run_time) in self._stats.iteritems()
+            )
+        return {'queue_depth': self.task_queue.qsize(), 'tasks': tasks}
@@ -1,76 +1,245 @@
-from asynch_executor import AsynchExecutor
+from asynch_executor import AsynchExecutor, TaskCancelled, current_future
 import logging
 import time
+from threading import Event
 from playlist_manager import PlaylistManager, PlaylistNotChanged
+from media_cleaner import InsufficientSpace
 from display.scheduler import Scheduler
 from status import StatusMonitor
+from http_session import HttpSession
+from poll_scheduler import PollScheduler
+from config_utils import get_option
 
 
 class Client(object):
 
     LOG = logging.getLogger(__name__)
 
-    def __init__(self, config):
-        self.executor = AsynchExecutor(2)
-        self.status_monitor = StatusMonitor(config)
-        self.pl_manager = PlaylistManager(config)
+    def __init__(self, config, scheduler=None, startup_timer=None):
+        '''
+        :param scheduler: A Scheduler that may already display the stored
+            playlist. A new one is created if not given.
+        :param startup_timer: A StartupTimer to report once the first
+            playlist poll has finished
+        '''
+        self.executor = AsynchExecutor(int(get_option(config, 'Client', 'task_workers', 3)))
+        # All network operations share one connection pool
+        self.http_session = HttpSession(config)
+        self.status_monitor = StatusMonitor(config, self.http_session)
+        self.pl_manager = PlaylistManager(config, self.http_session)
         self.POLL_TIME = config.getfloat('Client', 'playlist_poll_time')
-        self.scheduler = Scheduler()
+        max_poll_time = float(get_option(config, 'Client', 'playlist_max_poll_time', 900))
+        self.poll_scheduler = PollScheduler(self.POLL_TIME, max_poll_time)
+        # In longpoll mode the server holds the playlist request open for up
+        # to LONG_POLL_WAIT seconds until the playlist changes
+        update_mode = get_option(config, 'Client', 'playlist_update_mode', 'poll')
+        if update_mode == 'longpoll':
+            self.LONG_POLL_WAIT = int(get_option(config, 'Client', 'longpoll_wait_time', 300))
+        else:
+            self.LONG_POLL_WAIT = None
+        self.scheduler = scheduler or Scheduler()
+        self.startup_timer = startup_timer
+        self.poll_finished = Event()
+        self.playlist_received = False
+        # Future of the latest playlist download
+        self.download_future = None
 
     def schedule_playlist(self, playlist, playlist_id, playlist_update_time):
         self.LOG.debug('Client scheduling playlist %s' % playlist)
         if len(playlist) == 0:
             self.LOG.debug('No media to schedule')
             return
-
-        def replace_playlist(scheduled_pl):
-            del scheduled_pl[:]
-            for media in playlist:
-                scheduled_pl.append(media)
-        self.scheduler.modify_playlist_atomically(replace_playlist)
+        self.scheduler.replace_playlist(playlist)
         self.status_monitor.confirm_new_playlist(playlist_id, playlist_update_time)
         if not self.scheduler.running:
             self.scheduler.start()
         self.status_monitor.submit_collected_events()
 
     def start(self):
-        # Get the first playlist from file. If there is no ready playlist,
-        # this returns an empty playlist
-        playlist = self.pl_manager.fetch_local_playlist()
-        self.schedule_playlist(playlist, None, None)
+        # Get the first playlist from file unless it is already displayed.
+        # If there is no ready playlist, this returns an empty playlist
+        if not self.scheduler.running:
+            playlist = self.pl_manager.fetch_local_playlist()
+            self.schedule_playlist(playlist, None, None)
 
         # Run by AsynchExecutor
-        def get_new_playlist_and_free_up_space_if_necessary():
-            return self.pl_manager.fetch_playlist()
+        def get_new_playlist():
+            return self.pl_manager.fetch_playlist(self.LONG_POLL_WAIT)
+
+        # Called by AsynchExecutor when a new playlist was fetched
+        def pl_fetch_success(fetched):
+            try:
+                self.playlist_received = True
+                self.report_startup_times()
+                self.update_poll_interval(error=None)
+                self.submit_download(fetched)
+            finally:
+                self.poll_finished.set()
 
         # Called by AsynchExecutor when there was an error
         def pl_fetch_error(error):
-            if isinstance(error, PlaylistNotChanged):
-                self.LOG.info('Playlist has not been changed on the server. Asynch task was aborted.')
-                self.status_monitor.submit_collected_events()
-                return
-            self.LOG.error('Exception fetching playlist: {0}'.format(error.message))
-            self.status_monitor.add_status(
-                StatusMonitor.EventTypes.ERROR,
-                StatusMonitor.Categories.CONNECTION,
-                str(error.message)
+            try:
+                self.report_startup_times()
+                if isinstance(error, PlaylistNotChanged):
+                    self.LOG.info('Playlist has not been changed on the server. Asynch task was aborted.')
+                    self.update_poll_interval(error=None)
+                    self.status_monitor.submit_collected_events()
+                    return
+                self.update_poll_interval(error)
+                self.report_error(error)
+            finally:
+                self.poll_finished.set()
+
+        def submit_poll():
+            self.executor.submit(
+                get_new_playlist,
+                on_success=pl_fetch_success,
+                on_error=pl_fetch_error,
+                priority=AsynchExecutor.HIGH,
+                key='poll'
             )
-            self.LOG.debug('Creating status obj')
-            self.status_monitor.submit_collected_events()
 
         self.executor.start()
+        self.status_monitor.start()
         try:
-            while True:
-                if not self.executor.is_full():
-                    self.executor.submit(
-                        get_new_playlist_and_free_up_space_if_necessary,
-                        on_success=self.schedule_playlist,
-                        on_error=pl_fetch_error
-                    )
-                else:
-                    self.LOG.debug('Executor task queue is full')
-                time.sleep(self.POLL_TIME)
+            if self.LONG_POLL_WAIT:
+                self.long_poll(submit_poll)
+            else:
+                self.poll_periodically(submit_poll)
         except KeyboardInterrupt:
             self.executor.shutdown()
+            self.status_monitor.shutdown()
             if self.scheduler:
                 self.scheduler.shutdown()
+
+    def submit_download(self, fetched):
+        '''
+        Downloads the files of a fetched playlist and schedules it. A
+        download still running for an older playlist is cancelled.
+        '''
+        def download_playlist(fetched):
+            return self.pl_manager.download_playlist(fetched, current_future().cancel_requested)
+
+        def download_success(result):
+            playlist, playlist_id, playlist_update_time = result
+            self.schedule_playlist(playlist, playlist_id, playlist_update_time)
+            self.executor.submit(self.report_stats, priority=AsynchExecutor.LOW, key='report_stats')
+
+        def download_error(error):
+            if isinstance(error, TaskCancelled):
+                self.LOG.info('Download of playlist %s was superseded by a newer playlist', fetched.playlist_id)
+                return
+            if isinstance(error, PlaylistNotChanged):
+                return
+            # PlaylistManager backs off downloading the failed playlist again
+            self.report_error(error)
+
+        if self.download_future is not None:
+            self.download_future.cancel()
+        self.download_future = self.executor.submit(
+            download_playlist,
+            on_success=download_success,
+            on_error=download_error,
+            params=(fetched,),
+            priority=AsynchExecutor.NORMAL
+        )
+
+    def report_error(self, error):
+        self.LOG.error('Exception fetching playlist: {0}'.format(error.message))
+        if isinstance(error, InsufficientSpace):
+            category = StatusMonitor.Categories.STORAGE
+        else:
+            category = StatusMonitor.Categories.CONNECTION
+        self.status_monitor.add_status(
+            StatusMonitor.EventTypes.ERROR,
+            category,
+            str(error.message)
+        )
+        self.LOG.debug('Creating status obj')
+        self.status_monitor.submit_collected_events()
+
+    def report_stats(self):
+        self.report_cache_stats()
+        self.report_display_stats()
+
+    def update_poll_interval(self, error):
+        headers = self.pl_manager.last_response_headers
+        if error is None:
+            changed = self.poll_scheduler.record_success(headers)
+        else:
+            changed = self.poll_scheduler.record_error(headers)
+        if changed:
+            self.status_monitor.add_status(
+                StatusMonitor.EventTypes.SUCCESS,
+                StatusMonitor.Categories.POLLING,
+                'Playlist poll interval is now {0:.0f}s'.format(self.poll_scheduler.interval)
+            )
+
+    def report_cache_stats(self):
+        stats = self.pl_manager.media_cleaner.get_stats()
+        self.status_monitor.add_status(
+            StatusMonitor.EventTypes.SUCCESS,
+            StatusMonitor.Categories.CACHE,
+            '{policy}: {hits} hits, {misses} misses, {evictions} evictions ({evicted_bytes} B)'.format(**stats)
+        )
+
+    def report_startup_times(self):
+        if self.startup_timer is None:
+            return
+        self.status_monitor.add_status(
+            StatusMonitor.EventTypes.SUCCESS,
+            StatusMonitor.Categories.STARTUP,
+            self.startup_timer.describe(self.scheduler.viewer.first_display_time)
+        )
+        # Reported only once
+        self.startup_timer = None
+
+    def report_display_stats(self):
+        stats = self.scheduler.get_timing_stats()
+        if not stats['drift']['count'] and not stats['interrupt_latency']['count']:
+            return
+        self.status_monitor.add_status(
+            StatusMonitor.EventTypes.SUCCESS,
+            StatusMonitor.Categories.DISPLAY,
+            # Descriptions are limited to 128 characters
+            'Mean/max drift {drift[mean]:.2f}/{drift[max]:.2f}s, gap {gap[mean]:.2f}/{gap[max]:.2f}s, '
+            'load {page_load[mean]:.2f}/{page_load[max]:.2f}s, '
+            'interrupt {interrupt_latency[mean]:.2f}/{interrupt_latency[max]:.2f}s'.format(**stats)
+        )
+
+    def wait_for_poll(self, submit_poll):
+        self.playlist_received = False
+        self.poll_finished.clear()
+        submit_poll()
+        # Waiting in short steps keeps KeyboardInterrupt working
+        while not self.poll_finished.wait(1):
+            pass
+        self.LOG.debug('HTTP connection stats: %s', self.http_session.get_stats())
+        self.LOG.debug('Status sender stats: %s', self.status_monitor.get_stats())
+        self.LOG.debug('Task executor stats: %s', self.executor.get_stats())
+
+    def poll_periodically(self, submit_poll):
+        '''
+        Polls the playlist with the delay given by the poll scheduler
+        between the end of a poll and the start of the next one.
+        '''
+        time.sleep(self.poll_scheduler.initial_delay())
+        while True:
+            self.wait_for_poll(submit_poll)
+            time.sleep(self.poll_scheduler.next_delay())
+
+    def long_poll(self, submit_poll):
+        '''
+        Keeps a playlist request open at all times. A new request is made
+        as soon as the previous one returns with a new playlist. Requests that
+        fail or that the server does not hold open are repeated after the
+        delay given by the poll scheduler instead.
+        '''
+        time.sleep(self.poll_scheduler.initial_delay())
+        while True:
+            poll_start_time = time.time()
+            self.wait_for_poll(submit_poll)
+            if not self.playlist_received:
+                remaining_time = self.poll_scheduler.next_delay() - (time.time() - poll_start_time)
+                if remaining_time > 0:
+                    time.sleep(remaining_time)
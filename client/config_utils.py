@@ -0,0 +1,9 @@
+def get_option(config, section, item, default):
+    '''
+    Returns the value of a configuration item or the given default if the
+    item is missing, e.g. from a properties file created by an older
+    version of configure.py.
+    '''
+    if config.has_option(section, item):
+        return config.get(section, item)
+    return default
@@ -1,20 +1,41 @@
-import requests
+import json
 import logging
 import os
-from urlparse import urlparse
 import re
 import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
 from hashlib import md5 as md5sum
+from Queue import Queue, Empty
+from threading import Thread, Lock
 from display.media import Media
+from preallocate import preallocate
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class DownloadCancelled(Exception):
+    pass
 
 
 class ResumableFileDownload(object):
     """
     Handles file operations on downloads.
+    The MD5 digest of the file is computed while the file is streamed.
     """
     MD5_STRING = "md5"
+    HASH_READ_SIZE = 64 * 1024
+    SEGMENT_CHECKPOINT_BYTES = 4 * 1024 * 1024
     LOG = logging.getLogger(__name__)
 
+    # Hash states of partial downloads keyed by the incomplete filepath.
+    # hashlib objects cannot be serialized, so the checkpoints are only
+    # kept in memory. After a restart the partial file is hashed once.
+    HASH_CHECKPOINTS = {}
+    HASH_CHECKPOINTS_LOCK = Lock()
+
     def __init__(self, url, media_folder, filename, expected_md5, expected_size):
         self.url = url
         if expected_md5:
@@ -24,32 +45,198 @@ class ResumableFileDownload(object):
         self.incomplete_filepath = self.complete_filepath + '.incomplete'
         self.expected_md5 = expected_md5
         self.expected_size = expected_size
+        self.file_md5 = None
+        # Byte ranges [start, end, bytes_done] of a segmented download
+        self.segments_filepath = self.incomplete_filepath + '.segments'
+        self.segments = None
+        self._segments_lock = Lock()
+        # Reservation of disk space for the download, set by ChunkedDownloader
+        self.reservation = None
+        # An Event set when the download is no longer needed
+        self.cancelled = None
 
     def is_complete(self):
         return os.path.isfile(self.complete_filepath)
 
-    def stream_to_file(self, iter_function):
-        with open(self.incomplete_filepath, 'ab') as f:
-            for chunk in iter_function(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
+    def stream_to_file(self, iter_function, rate_limiter):
+        hasher, bytes_hashed = self.resume_hash()
+        try:
+            with open(self.incomplete_filepath, 'ab') as f:
+                for chunk in iter_function(chunk_size=1024):
+                    self.check_cancelled()
+                    if chunk:
+                        rate_limiter.consume(len(chunk))
+                        f.write(chunk)
+                        if self.reservation:
+                            self.reservation.written(len(chunk))
+                        hasher.update(chunk)
+                        bytes_hashed += len(chunk)
+        finally:
+            with self.HASH_CHECKPOINTS_LOCK:
+                self.HASH_CHECKPOINTS[self.incomplete_filepath] = (hasher, bytes_hashed)
+        self.file_md5 = hasher.hexdigest()
+
+    def check_cancelled(self):
+        '''
+        Progress is kept, so a cancelled download can be resumed later.
+        '''
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise DownloadCancelled('Download of {0} cancelled'.format(self.url))
+
+    def resume_hash(self):
+        '''
+        Returns a tuple (hasher, bytes_hashed) for continuing to hash the
+        partial file. Uses the checkpoint of an earlier attempt if it matches
+        the file, otherwise hashes the partial file in constant memory.
+        '''
+        bytes_downloaded = self.bytes_downloaded()
+        with self.HASH_CHECKPOINTS_LOCK:
+            checkpoint = self.HASH_CHECKPOINTS.pop(self.incomplete_filepath, None)
+        if checkpoint and checkpoint[1] == bytes_downloaded:
+            return checkpoint
+        hasher = md5sum()
+        if bytes_downloaded > 0:
+            self.LOG.debug('Hashing %s bytes of partial download %s', bytes_downloaded, self.incomplete_filepath)
+            with open(self.incomplete_filepath, 'rb') as f:
+                for block in iter(lambda: f.read(self.HASH_READ_SIZE), b''):
+                    hasher.update(block)
+        return hasher, bytes_downloaded
 
     def download_complete(self):
         if os.path.isfile(self.incomplete_filepath):
             self.LOG.debug("is a file")
-            with open(self.incomplete_filepath) as f:
-                file_md5 = md5sum(f.read()).hexdigest()
+            file_md5 = self.file_md5
+            if file_md5 is None:
+                file_md5 = self.resume_hash()[0].hexdigest()
+            with self.HASH_CHECKPOINTS_LOCK:
+                self.HASH_CHECKPOINTS.pop(self.incomplete_filepath, None)
             self.LOG.debug("md5: %s", file_md5)
             self.LOG.debug("comparing to md5: %s", self.expected_md5)
-            if not self.expected_md5:
-                os.rename(self.incomplete_filepath, self.complete_filepath)
-                return
-            elif file_md5 == self.expected_md5:
+            if not self.expected_md5 or file_md5 == self.expected_md5:
                 os.rename(self.incomplete_filepath, self.complete_filepath)
+                if os.path.isfile(self.segments_filepath):
+                    os.remove(self.segments_filepath)
                 return
+            # Resuming a corrupted file would fail the same way every time
+            self.LOG.error('MD5 of %s does not match, discarding the download', self.url)
+            self.discard_segments()
         raise Exception("Error completing download.")
 
+    def is_segmented(self):
+        '''
+        A progress file without the full size incomplete file it describes is
+        left over from a removed or restarted download. It is discarded so
+        that the download starts over instead of writing to a wrong file.
+        '''
+        if not os.path.isfile(self.segments_filepath):
+            return False
+        if os.path.isfile(self.incomplete_filepath) and \
+                os.path.getsize(self.incomplete_filepath) == self.expected_size:
+            return True
+        self.LOG.info('Discarding orphaned segments of %s', self.url)
+        self.discard_segments()
+        return False
+
+    def partial_filepaths(self):
+        return [self.incomplete_filepath, self.segments_filepath]
+
+    def preallocate(self):
+        '''
+        Allocates the disk blocks for the rest of the file.
+        :return: Whether the blocks were allocated
+        '''
+        offset = 0 if self.is_segmented() else self.bytes_downloaded()
+        with open(self.incomplete_filepath, 'ab') as f:
+            return preallocate(f, offset, self.expected_size - offset)
+
+    def start_segments(self, segment_count):
+        '''
+        Splits the empty incomplete file into byte ranges which are
+        downloaded and resumed independently. The file is extended to its
+        full size so that the segments can be written at their offsets.
+        It is not reopened for writing, which would free the blocks
+        allocated by preallocate().
+        '''
+        segment_size = -(-self.expected_size // segment_count)
+        self.segments = [
+            [start, min(start + segment_size, self.expected_size) - 1, 0]
+            for start in range(0, self.expected_size, segment_size)
+        ]
+        with open(self.incomplete_filepath, 'ab') as f:
+            f.truncate(self.expected_size)
+        with self._segments_lock:
+            self.save_segments()
+
+    def discard_segments(self):
+        for filepath in (self.segments_filepath, self.incomplete_filepath):
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+        self.segments = None
+
+    def load_segments(self):
+        if self.segments is None:
+            if not self.is_segmented():
+                raise Exception('Download of {0} has no segments'.format(self.url))
+            with open(self.segments_filepath, 'r') as f:
+                self.segments = json.loads(f.read())
+        return self.segments
+
+    def save_segments(self):
+        tmp_filepath = self.segments_filepath + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            f.write(json.dumps(self.segments))
+        os.rename(tmp_filepath, self.segments_filepath)
+
+    def pending_segments(self):
+        return [index for index, (start, end, done) in enumerate(self.load_segments())
+                if start + done <= end]
+
+    def segment_range(self, index):
+        start, end, done = self.load_segments()[index]
+        return start + done, end
+
+    def stream_segment(self, index, iter_function, rate_limiter):
+        '''
+        Writes a segment at its offset in the incomplete file. Progress is
+        saved only after the written bytes have been synced to the disk.
+        '''
+        start, end, done = self.load_segments()[index]
+        position = start + done
+        unsaved_bytes = 0
+        with open(self.incomplete_filepath, 'r+b') as f:
+            f.seek(position)
+            try:
+                for chunk in iter_function(chunk_size=1024):
+                    self.check_cancelled()
+                    if not chunk:
+                        continue
+                    chunk = chunk[:end + 1 - position]
+                    rate_limiter.consume(len(chunk))
+                    f.write(chunk)
+                    if self.reservation:
+                        self.reservation.written(len(chunk))
+                    position += len(chunk)
+                    unsaved_bytes += len(chunk)
+                    if unsaved_bytes >= self.SEGMENT_CHECKPOINT_BYTES:
+                        self.checkpoint_segment(f, index, position - start)
+                        unsaved_bytes = 0
+                    if position > end:
+                        break
+            finally:
+                self.checkpoint_segment(f, index, position - start)
+        if position <= end:
+            raise Exception('Segment {0} of {1} ended at byte {2}'.format(index, self.url, position))
+
+    def checkpoint_segment(self, f, index, done):
+        f.flush()
+        os.fsync(f.fileno())
+        with self._segments_lock:
+            self.segments[index][2] = done
+            self.save_segments()
+
     def bytes_downloaded(self):
+        if self.is_segmented():
+            return sum(done for start, end, done in self.load_segments())
         if os.path.isfile(self.incomplete_filepath):
             return os.path.getsize(self.incomplete_filepath)
         return 0
@@ -62,31 +249,66 @@ class ChunkedDownloader(object):
 
     LOG = logging.getLogger(__name__)
 
-    def __init__(self, server_url, device_id, media_folder, timeouts, media_cleaner):
-        self.HISRA_NET_LOC = urlparse(server_url).netloc
-        self.AUTHORIZATION_HEADER = 'Device %s' % device_id
+    def __init__(self, http_session, media_folder, timeouts, media_cleaner,
+                 manifest, revalidate_media=True, segments=1, segmented_min_size=0, deadline=None):
+        self.HTTP_SESSION = http_session
         self.MEDIA_FOLDER = media_folder
         self.TIMEOUTS = timeouts # wait for bytes 60s wait to establish connection 60s
         self.MEDIA_CLEANER = media_cleaner
+        self.MANIFEST = manifest
+        self.REVALIDATE_MEDIA = revalidate_media
+        # Files of at least SEGMENTED_MIN_SIZE bytes are downloaded as
+        # SEGMENTS concurrent byte ranges
+        self.SEGMENTS = segments
+        self.SEGMENTED_MIN_SIZE = segmented_min_size
+        # Time limit in seconds for each request including its body, None
+        # for no limit. An interrupted download is resumed the next time.
+        self.DEADLINE = deadline
 
     def set_hisra_net_loc(self, server_media_url):
-        netloc = urlparse(server_media_url).netloc
-        if netloc:
-            self.HISRA_NET_LOC = netloc
-
-    def download(self, content):
+        # Media from our own media server requires device authentication
+        self.HTTP_SESSION.trust_url(server_media_url)
+
+    def download(self, content, cancelled=None):
+        '''
+        :param cancelled: An Event that stops the download when set
+        :return: The path of the downloaded file
+        '''
         url = content.content_uri
         headers = {'Content-Type':Media.VALID_CONTENT_TYPES[content.content_type]}
-        if urlparse(url).netloc == self.HISRA_NET_LOC:
-            headers['Authorization'] = self.AUTHORIZATION_HEADER
 
-        response = requests.get(
+        entry = self.MANIFEST.get(url)
+        if entry is not None:
+            if self.MANIFEST.is_available(entry):
+                if not self.REVALIDATE_MEDIA:
+                    self.LOG.debug('Using media %s from manifest', url)
+                    self.MEDIA_CLEANER.cache_hit(entry['path'])
+                    return entry['path']
+                headers.update(self.MANIFEST.validator_headers(entry))
+            elif not entry.get('complete', False):
+                # Continue an interrupted download without probing the server
+                resumable_download = ResumableFileDownload(url, self.MEDIA_FOLDER, entry['filename'],
+                                                           entry['md5'], entry['size'])
+                resumable_download.cancelled = cancelled
+                if resumable_download.bytes_downloaded() > 0:
+                    with self.MEDIA_CLEANER.downloading(resumable_download.partial_filepaths()), \
+                            self.reserve_space(resumable_download):
+                        return self.continue_download(url, headers, resumable_download)
+
+        response = self.HTTP_SESSION.get(
             url,
             timeout=self.TIMEOUTS,
             stream=True,
-            headers=headers
+            headers=headers,
+            deadline=self.DEADLINE
         )
 
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            self.LOG.debug('Media %s not modified', url)
+            self.MEDIA_CLEANER.cache_hit(entry['path'])
+            return entry['path']
+
         if response.status_code != 200:
             raise Exception("Expected 200 response got: %s", response.status_code)
 
@@ -100,34 +322,258 @@ class ChunkedDownloader(object):
         if content_length is None:
             raise Exception("Response from {0} had no content-length. Download aborted.".format(url))
 
-        self.MEDIA_CLEANER.clean_media(content_length)
-
         resumable_download = ResumableFileDownload(url, self.MEDIA_FOLDER, filename,
                                                    md5, content_length)
+        resumable_download.cancelled = cancelled
+        self.MANIFEST.update(
+            url,
+            filename=filename,
+            path=resumable_download.complete_filepath,
+            md5=md5,
+            size=content_length,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+            complete=False
+        )
 
         if resumable_download.is_complete():
             response.close()
+            self.MANIFEST.update(url, complete=True)
+            self.MEDIA_CLEANER.cache_hit(resumable_download.complete_filepath)
             return resumable_download.complete_filepath
 
-        bytes_downloaded = resumable_download.bytes_downloaded()
-        if bytes_downloaded > 0:
+        with self.MEDIA_CLEANER.downloading(resumable_download.partial_filepaths()), \
+                self.reserve_space(resumable_download):
+            return self.fetch_file(url, headers, resumable_download, response)
+
+    @contextmanager
+    def reserve_space(self, resumable_download):
+        '''
+        Reserves the space the rest of the download needs for as long as it
+        runs. If the blocks can be preallocated, the file system accounts for
+        them and the reservation is settled right away.
+        '''
+        missing_bytes = resumable_download.expected_size - resumable_download.bytes_downloaded()
+        with self.MEDIA_CLEANER.reserve(missing_bytes) as reservation:
+            if resumable_download.preallocate():
+                reservation.settle()
+            resumable_download.reservation = reservation
+            try:
+                yield
+            finally:
+                resumable_download.reservation = None
+
+    def fetch_file(self, url, headers, resumable_download, response):
+        content_length = resumable_download.expected_size
+        if resumable_download.is_segmented() or resumable_download.bytes_downloaded() > 0:
             response.close()
-            self.LOG.debug('Resuming a download with range: %s-%s', bytes_downloaded, resumable_download.expected_size)
+            return self.continue_download(url, headers, resumable_download)
 
-            headers['Range'] = 'bytes={0}-{1}'.format(bytes_downloaded, resumable_download.expected_size)
-            response = requests.get(url=url,
-                                    timeout=self.TIMEOUTS,
-                                    stream=True,
-                                    headers=headers)
-            if response.status_code != 206:
-                raise Exception("Requested a range(206) but got: %s", response.status_code)
+        if self.SEGMENTS > 1 and content_length >= self.SEGMENTED_MIN_SIZE and \
+                response.headers.get('Accept-Ranges') == 'bytes':
+            response.close()
+            resumable_download.start_segments(self.SEGMENTS)
+            try:
+                return self.download_segments(url, headers, resumable_download)
+            except RangeNotSupported:
+                self.LOG.info('Ranges not supported for %s, downloading as a single stream', url)
+                resumable_download.discard_segments()
+                # Deleting the file freed its blocks
+                if not resumable_download.preallocate() and resumable_download.reservation:
+                    resumable_download.reservation.reset(content_length)
+            response = self.HTTP_SESSION.get(
+                url,
+                timeout=self.TIMEOUTS,
+                stream=True,
+                headers=headers,
+                deadline=self.DEADLINE
+            )
+            if response.status_code != 200:
+                raise Exception("Expected 200 response got: %s", response.status_code)
+
+        resumable_download.stream_to_file(response.iter_content, self.HTTP_SESSION.download_limiter)
+
+        return self.complete_download(url, resumable_download)
+
+    def continue_download(self, url, headers, resumable_download):
+        if resumable_download.is_segmented():
+            return self.download_segments(url, headers, resumable_download)
+        return self.resume_download(url, headers, resumable_download)
+
+    def request_range(self, url, headers, first_byte, last_byte):
+        headers = dict(headers)
+        headers['Range'] = 'bytes={0}-{1}'.format(first_byte, last_byte)
+        response = self.HTTP_SESSION.get(url,
+                                         timeout=self.TIMEOUTS,
+                                         stream=True,
+                                         headers=headers,
+                                         deadline=self.DEADLINE)
+        if response.status_code != 206:
+            response.close()
+            raise RangeNotSupported("Requested a range(206) but got: %s" % response.status_code)
+        return response
+
+    def download_segments(self, url, headers, resumable_download):
+        '''
+        Downloads the pending segments of the file concurrently. The first
+        segment is requested before the others to find out whether the
+        server supports ranges at all.
+        '''
+        pending = resumable_download.pending_segments()
+        self.LOG.debug('Downloading %s segments of %s', len(pending), url)
+        errors = []
+
+        def stream_segment(index, response):
+            try:
+                if response is None:
+                    response = self.request_range(url, headers, *resumable_download.segment_range(index))
+                resumable_download.stream_segment(index, response.iter_content,
+                                                   self.HTTP_SESSION.download_limiter)
+            except Exception as e:
+                self.LOG.debug('Segment %s of %s failed: %s', index, url, e)
+                errors.append(e)
+
+        if pending:
+            first_response = self.request_range(url, headers, *resumable_download.segment_range(pending[0]))
+            workers = [Thread(target=stream_segment, args=(index, None)) for index in pending[1:]]
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+            stream_segment(pending[0], first_response)
+            for worker in workers:
+                worker.join()
+        if errors:
+            raise errors[0]
+
+        return self.complete_download(url, resumable_download)
+
+    def resume_download(self, url, headers, resumable_download):
+        bytes_downloaded = resumable_download.bytes_downloaded()
+        self.LOG.debug('Resuming a download with range: %s-%s', bytes_downloaded, resumable_download.expected_size)
 
-        resumable_download.stream_to_file(response.iter_content)
+        response = self.request_range(url, headers, bytes_downloaded, resumable_download.expected_size)
 
-        resumable_download.download_complete()
+        resumable_download.stream_to_file(response.iter_content, self.HTTP_SESSION.download_limiter)
+
+        return self.complete_download(url, resumable_download)
 
+    def complete_download(self, url, resumable_download):
+        resumable_download.download_complete()
+        self.MANIFEST.update(url, complete=True)
+        self.MEDIA_CLEANER.media_downloaded(resumable_download.complete_filepath,
+                                            resumable_download.expected_size)
         return resumable_download.complete_filepath
 
+    def download_all(self, contents, worker_count=1, cancelled=None):
+        '''
+        Downloads the given contents using at most worker_count threads.
+        Contents with identical URLs are downloaded only once. A failing
+        download does not stop the others.
+        :param contents: Instances of Media to download
+        :param worker_count: Maximum number of concurrent downloads
+        :param cancelled: An Event that stops the downloads when set. The
+            contents not downloaded yet are then in neither dict.
+        :return: A tuple (local_paths, failures) of dicts keyed by URL
+        '''
+        self.LOG.debug('Downloading files using %s workers', worker_count)
+
+        def download(content):
+            return self.download(content, cancelled)
+        return self.run_in_parallel(download, contents, worker_count, cancelled)
+
+    def plan_download(self, contents, worker_count=1):
+        '''
+        Finds out how many bytes downloading the given contents still needs
+        without downloading them. Sizes of files that are not in the manifest
+        are requested with HEAD requests using at most worker_count threads.
+        :return: A tuple (required_bytes, local_filepaths, failures) where
+            local_filepaths are the files of the contents already on the disk
+            and failures maps the URLs whose size is unknown to the exception
+        '''
+        sizes, failures = self.run_in_parallel(self.required_bytes, contents, worker_count)
+        for url, error in failures.iteritems():
+            self.LOG.info('Could not find out the size of %s: %s', url, error)
+        required_bytes = 0
+        local_filepaths = []
+        for missing_bytes, filepaths in sizes.itervalues():
+            required_bytes += missing_bytes
+            local_filepaths.extend(filepaths)
+        return required_bytes, local_filepaths, failures
+
+    def required_bytes(self, content):
+        '''
+        :return: A tuple (missing_bytes, local_filepaths) for the content
+        '''
+        url = content.content_uri
+        entry = self.MANIFEST.get(url)
+        if entry is not None:
+            if self.MANIFEST.is_available(entry):
+                return 0, [entry['path']]
+            if not entry.get('complete', False):
+                resumable_download = ResumableFileDownload(url, self.MEDIA_FOLDER, entry['filename'],
+                                                           entry['md5'], entry['size'])
+                return (resumable_download.expected_size - resumable_download.bytes_downloaded(),
+                        resumable_download.partial_filepaths())
+
+        headers = {'Content-Type':Media.VALID_CONTENT_TYPES[content.content_type]}
+        response = self.HTTP_SESSION.head(url,
+                                          timeout=self.TIMEOUTS,
+                                          headers=headers,
+                                          allow_redirects=True,
+                                          deadline=self.DEADLINE)
+        if response.status_code != 200:
+            raise Exception("Expected 200 response got: %s" % response.status_code)
+        content_length = int(response.headers['Content-Length'])
+        resumable_download = ResumableFileDownload(url, self.MEDIA_FOLDER, self.get_filename(response, url),
+                                                   response.headers.get('Content-MD5'), content_length)
+        if resumable_download.is_complete():
+            return 0, [resumable_download.complete_filepath]
+        return content_length - resumable_download.bytes_downloaded(), resumable_download.partial_filepaths()
+
+    def run_in_parallel(self, function, contents, worker_count, cancelled=None):
+        '''
+        Calls function for every unique URL of the contents using at most
+        worker_count threads. A failing call does not stop the others.
+        No more calls are made once cancelled is set.
+        :return: A tuple (results, failures) of dicts keyed by URL
+        '''
+        unique_contents = OrderedDict()
+        for content in contents:
+            unique_contents.setdefault(content.content_uri, content)
+
+        work_queue = Queue()
+        for url, content in unique_contents.iteritems():
+            work_queue.put((url, content))
+
+        results = {}
+        failures = {}
+        results_lock = Lock()
+
+        def worker_loop():
+            while cancelled is None or not cancelled.is_set():
+                try:
+                    url, content = work_queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    result = function(content)
+                except Exception as e:
+                    self.LOG.debug('Failed to process content, %s %s', content, e)
+                    with results_lock:
+                        failures[url] = e
+                else:
+                    with results_lock:
+                        results[url] = result
+
+        worker_count = max(1, min(worker_count, len(unique_contents)))
+        workers = [Thread(target=worker_loop) for _ in range(worker_count)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results, failures
+
     @staticmethod
     def get_filename(response, url):
         filename = response.headers.get('Content-Disposition')
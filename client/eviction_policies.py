@@ -0,0 +1,101 @@
+from abc import ABCMeta, abstractmethod
+
+
+class EvictionPolicy(object):
+    '''
+    An interface for deciding which unused media files are removed first
+    when disk space runs out. Policies work on the entries of a MediaIndex,
+    which have the keys 'size', 'last_use' and 'uses'. Policies may keep
+    their own state in the entries.
+    '''
+    __metaclass__ = ABCMeta
+
+    def file_used(self, entry):
+        '''
+        Called when a file is downloaded, found in the cache or taken into
+        use by a new playlist.
+        '''
+        pass
+
+    def file_evicted(self, entry):
+        '''
+        Called when a file is removed by the media cleaner.
+        '''
+        pass
+
+    @abstractmethod
+    def priority(self, filepath, entry):
+        '''
+        :return: A sort key, the files with the lowest keys are removed first
+        '''
+        pass
+
+
+class LruPolicy(EvictionPolicy):
+    '''
+    Removes the least recently used files first.
+    '''
+
+    def priority(self, filepath, entry):
+        return entry['last_use']
+
+
+class LfuPolicy(EvictionPolicy):
+    '''
+    Removes the least frequently used files first. Ties are broken by the
+    last use time.
+    '''
+
+    def priority(self, filepath, entry):
+        return entry['uses'], entry['last_use']
+
+
+class GreedyDualSizePolicy(EvictionPolicy):
+    '''
+    GreedyDual-Size with a uniform cost: a used file gets the value
+    L + 1 / size and the file with the lowest value is removed first.
+    L is raised to the value of every removed file, so files that have not
+    been used for a while lose to recently used ones. Large files are
+    removed before small files used at the same time.
+    '''
+
+    def __init__(self, entries):
+        values = [entry['gds'] for entry in entries if 'gds' in entry]
+        self.inflation = min(values) if values else 0.0
+
+    def file_used(self, entry):
+        entry['gds'] = self.inflation + 1.0 / max(entry['size'], 1)
+
+    def file_evicted(self, entry):
+        self.inflation = max(self.inflation, entry.get('gds', 0.0))
+
+    def priority(self, filepath, entry):
+        return entry.get('gds', 0.0)
+
+
+class PlaylistHistoryPolicy(EvictionPolicy):
+    '''
+    Keeps the files of the last playlists taken into use. These are only
+    removed when removing all other unused files is not enough, in least
+    recently used order like the rest.
+    '''
+
+    def __init__(self, history):
+        self.history = history
+
+    def priority(self, filepath, entry):
+        in_history = any(filepath in playlist for playlist in self.history)
+        return in_history, entry['last_use']
+
+
+def create_eviction_policy(name, entries, history):
+    '''
+    Creates the policy called name (lru, lfu, gds or history).
+    '''
+    if name == 'lfu':
+        return LfuPolicy()
+    if name == 'gds':
+        return GreedyDualSizePolicy(entries)
+    if name == 'history':
+        return PlaylistHistoryPolicy(history)
+    return LruPolicy()
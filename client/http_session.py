@@ -0,0 +1,149 @@
+import logging
+import time
+from threading import Lock
+from urlparse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from config_utils import get_option
+from rate_limiter import create_rate_limiter
+from display.timing import monotonic
+
+
+class OperationTimeout(requests.exceptions.Timeout):
+    '''
+    Raised when a request, including reading the response body, does not
+    finish before its deadline.
+    '''
+    pass
+
+
+class HttpSession(object):
+    '''
+    A connection pooling HTTP client shared by the downloader, the playlist
+    manager and the status monitor. Connections are kept alive and reused
+    between requests to the same host. Requests to trusted hosts (the server
+    and the media server) get the device Authorization header.
+    Media downloads are shaped by download_limiter, which is told the
+    latency of all other (non-streamed) requests.
+    The timeouts of requests limit each wait for the socket, so a server
+    sending a few bytes at a time could hold a request open for ever. A
+    request given a deadline fails with OperationTimeout once the whole
+    operation, reading the body included, has taken deadline seconds.
+    '''
+
+    LOG = logging.getLogger(__name__)
+
+    def __init__(self, config):
+        server_url = config.get('Server', 'server_url')
+        # Device ID
+        device_id_file = open(config.get('Device', 'device_id_file'), 'r')
+        device_id = device_id_file.read().strip()
+        device_id_file.close()
+        self.AUTHORIZATION_HEADER = 'Device {0}'.format(device_id)
+
+        # Maximum number of connections kept alive per host
+        pool_size = int(get_option(config, 'Client', 'http_pool_size', 10))
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self.download_limiter = create_rate_limiter(config)
+
+        self._trusted_netlocs = set([urlparse(server_url).netloc])
+        self._stats_lock = Lock()
+        self._request_count = 0
+
+    def trust_url(self, url):
+        '''
+        Adds the host of the URL to the hosts which receive the device
+        Authorization header.
+        '''
+        netloc = urlparse(url).netloc
+        if netloc:
+            self._trusted_netlocs.add(netloc)
+
+    def request(self, method, url, **kwargs):
+        headers = dict(kwargs.pop('headers', None) or {})
+        if urlparse(url).netloc in self._trusted_netlocs:
+            headers['Authorization'] = self.AUTHORIZATION_HEADER
+        with self._stats_lock:
+            self._request_count += 1
+        # Held open requests (long polls) say nothing about the latency
+        measure_latency = kwargs.pop('measure_latency', not kwargs.get('stream', False))
+        deadline = kwargs.pop('deadline', None)
+        start_time = time.time()
+        if deadline:
+            response = self.request_with_deadline(method, url, headers, deadline, kwargs)
+        else:
+            response = self._session.request(method, url, headers=headers, **kwargs)
+        if measure_latency:
+            self.download_limiter.record_latency(time.time() - start_time)
+        return response
+
+    def request_with_deadline(self, method, url, headers, deadline, kwargs):
+        '''
+        Makes a streamed request whose body is read through iter_content
+        checking the deadline. A non-streamed body is read here.
+        '''
+        expires = monotonic() + deadline
+        stream = kwargs.pop('stream', False)
+        # A single wait for the socket must not outlast the deadline either
+        kwargs['timeout'] = self.limit_timeout(kwargs.get('timeout'), deadline)
+        response = self._session.request(method, url, headers=headers, stream=True, **kwargs)
+        iter_content = response.iter_content
+
+        def iter_content_until_deadline(*args, **kwargs):
+            for chunk in iter_content(*args, **kwargs):
+                if monotonic() > expires:
+                    response.close()
+                    raise OperationTimeout('{0} {1} took more than {2}s'.format(method, url, deadline))
+                yield chunk
+
+        response.iter_content = iter_content_until_deadline
+        if not stream:
+            # Reads the body using iter_content
+            response.content
+        return response
+
+    @staticmethod
+    def limit_timeout(timeout, deadline):
+        if timeout is None:
+            return deadline, deadline
+        if isinstance(timeout, tuple):
+            return tuple(deadline if t is None else min(t, deadline) for t in timeout)
+        return min(timeout, deadline)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def get_stats(self):
+        '''
+        Returns the number of requests made and how many connections were
+        opened and reused by the connection pools.
+        '''
+        connections_opened = 0
+        pooled_requests = 0
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                try:
+                    pool = pools[key]
+                except KeyError:
+                    continue  # Pool was discarded meanwhile
+                connections_opened += pool.num_connections
+                pooled_requests += pool.num_requests
+        return {
+            'requests': self._request_count,
+            'connections_opened': connections_opened,
+            'connections_reused': max(0, pooled_requests - connections_opened)
+        }
@@ -1,80 +1,250 @@
 import logging
 import os
-from stat import ST_ATIME
+from threading import Lock
 from display.media import Media
+from media_index import MediaIndex
+from config_utils import get_option
+
+
+class InsufficientSpace(Exception):
+    '''
+    Raised when there is not enough space for a playlist even after removing
+    all unused media.
+    '''
+    def __init__(self, required_bytes, available_bytes):
+        self.required_bytes = required_bytes
+        self.available_bytes = available_bytes
+        super(InsufficientSpace, self).__init__(
+            'Playlist needs {0} MB but only {1} MB can be freed'.format(
+                required_bytes / 1000000, available_bytes / 1000000)
+        )
+
+
+class Reservation(object):
+    '''
+    Disk space promised to a running download. The outstanding bytes shrink
+    as the download writes its data and the rest is released when the
+    download ends. Use as a context manager.
+    '''
+    def __init__(self, media_cleaner, outstanding_bytes):
+        self.media_cleaner = media_cleaner
+        self.outstanding_bytes = outstanding_bytes
+        # Segments of a download write concurrently
+        self._lock = Lock()
+
+    def written(self, nbytes):
+        with self._lock:
+            self.outstanding_bytes = max(0, self.outstanding_bytes - nbytes)
+
+    def settle(self):
+        '''
+        Called when the space has been allocated on the disk, after which
+        the free space reported by the file system already accounts for it.
+        '''
+        with self._lock:
+            self.outstanding_bytes = 0
+
+    def reset(self, outstanding_bytes):
+        '''
+        Called when allocated space was freed again before it was written.
+        '''
+        with self._lock:
+            self.outstanding_bytes = outstanding_bytes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.media_cleaner.release(self)
+
 
 class MediaCleaner(object):
     '''
     Checks available disk space and removes unused media.
+    Unused media is looked up from a MediaIndex instead of scanning the
+    media folder and removed in the order of the configured eviction policy.
+    Counts cache hits and misses of downloads to help choosing the policy.
+    Keeps a ledger of space reserved by running downloads. Free space is
+    always counted without the reserved bytes.
     '''
     LOG = logging.getLogger(__name__)
 
-    def __init__(self, config, playlist_parser):
+    def __init__(self, config, playlist_parser, index_filepath, manifest=None):
+        '''
+        :param manifest: A MediaManifest whose entries of removed files are
+            removed too
+        '''
         threshold_mb = int(config.get('Storage', 'cleanup_threshold_mb'))
         self.CLEANUP_THRESHOLD_BYTES = threshold_mb * 1000 * 1000
         extra_space = int(config.get('Storage', 'cleanup_extra_space_to_free_up_mb'))
         self.EXTRA_SPACE_TO_FREE_UP_BYTES = extra_space * 1000 * 1000
         self.MEDIA_FOLDER = config.get('Storage', 'media_folder')
         self.PLAYLIST_PARSER = playlist_parser
+        self.MANIFEST = manifest
+        policy_name = get_option(config, 'Storage', 'eviction_policy', 'lru')
+        history_length = int(get_option(config, 'Storage', 'eviction_history_playlists', 3))
+        self.INDEX = MediaIndex(index_filepath, self.MEDIA_FOLDER, policy_name, history_length)
+        self.POLICY_NAME = policy_name
+        # Guards the counters, downloads update them in parallel
+        self._stats_lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        try:
+            self.playlist_activated(self.PLAYLIST_PARSER.get_stored_playlist())
+        except Exception:
+            self.LOG.debug('No stored playlist, all media is unused')
+        # Guards the reservations and the removal of files, downloads reserve
+        # space and playlists plan it in parallel
+        self._cleanup_lock = Lock()
+        self._reservations = set()
         self.LOG.debug('Initialized %s' % __name__)
 
-    def enough_space(self, content_length):
+    def free_bytes(self):
         statvfs = os.statvfs(self.MEDIA_FOLDER)
         free_blocks = statvfs.f_bavail
         block_size = statvfs.f_frsize
-        free_bytes = free_blocks* block_size
+        return free_blocks * block_size - self.reserved_bytes()
+
+    def reserved_bytes(self):
+        return sum(reservation.outstanding_bytes for reservation in list(self._reservations))
+
+    def reserve(self, nbytes):
+        '''
+        Reserves space for a download, cleaning up old media first if
+        necessary.
+        :return: A Reservation to be used as a context manager
+        '''
+        with self._cleanup_lock:
+            if not self.enough_space(nbytes):
+                self.run_cleanup(nbytes)
+            reservation = Reservation(self, nbytes)
+            self._reservations.add(reservation)
+        self.LOG.debug('Reserved %s bytes, %s bytes reserved in total', nbytes, self.reserved_bytes())
+        return reservation
+
+    def release(self, reservation):
+        with self._cleanup_lock:
+            self._reservations.discard(reservation)
+
+    def enough_space(self, content_length, free_bytes=None):
+        if free_bytes is None:
+            free_bytes = self.free_bytes()
         self.LOG.debug('Free space in bytes: %s',free_bytes)
         self.LOG.debug('Content_length: %s and cleanup threshold: %s', content_length, self.CLEANUP_THRESHOLD_BYTES)
         if free_bytes < (content_length + self.CLEANUP_THRESHOLD_BYTES):
             return False
         return True
 
-    def clean_media(self, content_length):
-        if not self.enough_space(content_length):
-            self.run_cleanup(content_length)
-
     def run_cleanup(self, content_length):
         self.LOG.debug('Cleaning up old media.')
-        unused_media = self.get_all_currently_unused_media()
-
-        for media in unused_media:
-            if self.enough_space(content_length + self.EXTRA_SPACE_TO_FREE_UP_BYTES):
+        # Free space is queried once and then updated by the sizes of the
+        # removed files
+        free_bytes = self.free_bytes()
+        files_to_remove = []
+        for filepath, size in self.INDEX.eviction_candidates():
+            if self.enough_space(content_length + self.EXTRA_SPACE_TO_FREE_UP_BYTES, free_bytes):
                 break
-            self.LOG.debug('Removing old media: %s', media[1])
-            os.remove(media[1])
+            files_to_remove.append(filepath)
+            free_bytes += size
+            with self._stats_lock:
+                self.evictions += 1
+                self.evicted_bytes += size
+        self.remove_files(files_to_remove)
 
         if not self.enough_space(content_length):
             raise Exception("Could not free up enough space")
 
-    def get_all_currently_unused_media(self):
-        current_media_files = []
-        stored_playlist = self.PLAYLIST_PARSER.get_stored_playlist()
-        if stored_playlist and len(stored_playlist):
-            for media in stored_playlist:
-                if media.content_type == Media.WEB_PAGE:
-                    continue
-                media_filepath = media.content_uri
-                current_media_files.append(media_filepath)
-        all_files = [os.path.join(self.MEDIA_FOLDER, file) for file in os.listdir(self.MEDIA_FOLDER)]
-        unused_files = []
-        for file in all_files:
-            file = file.encode('UTF-8')
-            if not file in current_media_files:
-                pair = (os.stat(file)[ST_ATIME], file)
-                unused_files.append(pair)
-
-        unused_files = sorted(unused_files)
-
-        self.LOG.debug('Found unused media files: %s' % unused_files)
-        return unused_files
-
-'''
-if __name__ == '__main__':
-    START_PATH = os.path.dirname(os.path.realpath(__file__))
-    CONFIG_PATH = os.path.join(START_PATH, 'client.properties')
-    config = ConfigParser.ConfigParser()
-    with open(CONFIG_PATH) as config_fp:
-        config.readfp(config_fp)
-    cleaner = MediaCleaner(config)
-    cleaner.clean_media()
-'''
+    def remove_files(self, filepaths):
+        self.INDEX.remove_files(filepaths)
+        if self.MANIFEST is not None:
+            self.MANIFEST.remove_paths(filepaths)
+
+    def plan_space(self, required_bytes):
+        '''
+        Makes space for all the files of a new playlist before downloading
+        them. Removes unused media in one pass, never touching the protected
+        files (see protecting()). Nothing is removed if the space cannot be
+        freed.
+        :raises InsufficientSpace: if removing all unused media is not enough
+        '''
+        with self._cleanup_lock:
+            free_bytes = self.free_bytes()
+            if self.enough_space(required_bytes, free_bytes):
+                return
+            self.LOG.debug('Planning space for %s bytes', required_bytes)
+            files_to_remove = []
+            freed_bytes = 0
+            for filepath, size in self.INDEX.eviction_candidates():
+                if self.enough_space(required_bytes + self.EXTRA_SPACE_TO_FREE_UP_BYTES, free_bytes + freed_bytes):
+                    break
+                files_to_remove.append(filepath)
+                freed_bytes += size
+            if not self.enough_space(required_bytes, free_bytes + freed_bytes):
+                available_bytes = max(0, free_bytes + freed_bytes - self.CLEANUP_THRESHOLD_BYTES)
+                raise InsufficientSpace(required_bytes, available_bytes)
+            with self._stats_lock:
+                self.evictions += len(files_to_remove)
+                self.evicted_bytes += freed_bytes
+            self.remove_files(files_to_remove)
+
+    def playlist_activated(self, playlist):
+        '''
+        Marks the files of the given playlist as the media currently in use.
+        '''
+        filepaths = []
+        for media in playlist:
+            if media.content_type == Media.WEB_PAGE:
+                continue
+            filepath = media.display_uri
+            if isinstance(filepath, unicode):
+                filepath = filepath.encode('UTF-8')
+            filepaths.append(filepath)
+        self.INDEX.set_references(filepaths)
+
+    def media_downloaded(self, filepath, size):
+        with self._stats_lock:
+            self.misses += 1
+        self.INDEX.add_file(filepath, size)
+
+    def cache_hit(self, filepath):
+        '''
+        Called when a file needed by a playlist is already on the disk. A
+        file missing from the index, e.g. after the index was rebuilt, is
+        added to it so that it can be evicted later.
+        '''
+        with self._stats_lock:
+            self.hits += 1
+        if not self.INDEX.file_used(filepath) and os.path.isfile(filepath):
+            self.INDEX.add_file(filepath, os.path.getsize(filepath))
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {
+                'policy': self.POLICY_NAME,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes
+            }
+
+    def downloading(self, partial_filepaths):
+        '''
+        Context manager protecting the partial files of a running download.
+        '''
+        return self.INDEX.downloading(partial_filepaths)
+
+    def protecting(self, filepaths):
+        '''
+        Context manager keeping the given files, and the files downloaded or
+        found on the disk while it is open, from being removed.
+        '''
+        return self.INDEX.protecting(filepaths)
+
+    def batch(self):
+        '''
+        Context manager saving the media index once at the end instead of
+        after every change.
+        '''
+        return self.INDEX.batch()
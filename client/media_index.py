@@ -0,0 +1,281 @@
+import errno
+import heapq
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from threading import RLock, Lock
+from eviction_policies import create_eviction_policy
+
+
+class MediaIndex(object):
+    '''
+    A persistent index of the files in the media folder with their size,
+    the time they were last used and how many times they have been used.
+    The index is built by scanning the media folder once and kept up to date
+    when downloads complete and when a new playlist is taken into use. It
+    also remembers the files of the last playlists.
+    Reference counts from the active playlist and the files of running
+    downloads are kept in memory. Those files are never eviction candidates;
+    the other files are ordered for removal by the eviction policy.
+    The partial files of a download are indexed and removed as one unit
+    keyed on the incomplete file.
+    Changes are saved to the disk at once, except inside batch(), where
+    they are saved once when the outermost batch ends.
+    '''
+
+    LOG = logging.getLogger(__name__)
+
+    # Files named <partial file>.<suffix> belong to the partial file
+    PARTIAL_SUFFIX = '.incomplete'
+
+    def __init__(self, index_filepath, media_folder, policy_name='lru', history_length=3):
+        self.INDEX_FILEPATH = index_filepath
+        self.MEDIA_FOLDER = media_folder
+        self.HISTORY_LENGTH = history_length
+        self._lock = RLock()
+        self._references = {}
+        self._downloading = set()
+        # Sets of files kept by open protecting() blocks
+        self._protected = []
+        self._files = {}
+        self._history = []
+        # Saving is deferred while batches are open
+        self._batch_depth = 0
+        self._dirty = False
+        self._save_lock = Lock()
+        self.load()
+        self.POLICY = create_eviction_policy(policy_name, self._files.values(), self._history)
+        self.LOG.debug('Using eviction policy %s', self.POLICY.__class__.__name__)
+
+    def load(self):
+        if os.path.isfile(self.INDEX_FILEPATH):
+            try:
+                with open(self.INDEX_FILEPATH, 'r') as index_file:
+                    data = json.loads(index_file.read())
+                for path, entry in data['files'].iteritems():
+                    self._files[path.encode('UTF-8')] = entry
+                self._history[:] = [
+                    set(path.encode('UTF-8') for path in playlist) for playlist in data['history']
+                ]
+                return
+            except Exception, e:
+                self.LOG.error('Media index corrupted, rebuilding it: %s', e)
+        self._files.update(self.scan_media_folder())
+        self.save()
+
+    def scan_media_folder(self):
+        files = {}
+        parts = []
+        for filename in os.listdir(self.MEDIA_FOLDER):
+            filepath = os.path.join(self.MEDIA_FOLDER, filename)
+            if not os.path.isfile(filepath):
+                continue
+            if self.PARTIAL_SUFFIX + '.' in filename:
+                parts.append(filepath)
+                continue
+            stat = os.stat(filepath)
+            files[filepath] = self.new_entry(stat.st_size, stat.st_mtime)
+        for filepath in parts:
+            partial_filepath = filepath[:filepath.rindex(self.PARTIAL_SUFFIX + '.') + len(self.PARTIAL_SUFFIX)]
+            if partial_filepath in files:
+                self.add_part(files[partial_filepath], filepath)
+            else:
+                self.LOG.debug('Removing orphaned partial file %s', filepath)
+                self.remove_file(filepath)
+        self.LOG.info('Indexed %s media files', len(files))
+        return files
+
+    @staticmethod
+    def add_part(entry, filepath):
+        entry['size'] += os.path.getsize(filepath)
+        entry.setdefault('parts', []).append(filepath)
+
+    @staticmethod
+    def remove_file(filepath):
+        try:
+            os.remove(filepath)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    @staticmethod
+    def new_entry(size, last_use):
+        return {'size': size, 'last_use': last_use, 'uses': 0}
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                data = json.dumps({
+                    'files': self._files,
+                    'history': [list(playlist) for playlist in self._history]
+                })
+                self._dirty = False
+            tmp_filepath = self.INDEX_FILEPATH + '.tmp'
+            with open(tmp_filepath, 'w') as index_file:
+                index_file.write(data)
+            os.rename(tmp_filepath, self.INDEX_FILEPATH)
+
+    def changed(self):
+        '''
+        Saves the index unless a batch is open.
+        '''
+        with self._lock:
+            self._dirty = True
+            if self._batch_depth:
+                return
+        self.save()
+
+    @contextmanager
+    def batch(self):
+        '''
+        Defers saving the changes made by any thread until the outermost
+        batch ends, e.g. while the files of a playlist are downloaded.
+        '''
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                save = self._batch_depth == 0 and self._dirty
+            if save:
+                self.save()
+
+    def _use(self, filepath, now):
+        entry = self._files[filepath]
+        entry['last_use'] = now
+        entry['uses'] += 1
+        self.POLICY.file_used(entry)
+
+    def add_file(self, filepath, size):
+        with self._lock:
+            self._files[filepath] = self.new_entry(size, time.time())
+            self._use(filepath, time.time())
+            self._protect(filepath)
+        self.changed()
+
+    def file_used(self, filepath):
+        '''
+        Called when an already downloaded file is needed again.
+        :return: False if the file is not in the index
+        '''
+        with self._lock:
+            if filepath not in self._files:
+                return False
+            self._use(filepath, time.time())
+            self._protect(filepath)
+        self.changed()
+        return True
+
+    def _protect(self, filepath):
+        for protected in self._protected:
+            protected.add(filepath)
+
+    @contextmanager
+    def protecting(self, filepaths):
+        '''
+        Keeps the given files, and the files added or used while the block is
+        open, from being eviction candidates, e.g. the files of a playlist
+        until all of them have been downloaded.
+        '''
+        protected = set(filepaths)
+        with self._lock:
+            self._protected.append(protected)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._protected.remove(protected)
+
+    def remove_files(self, filepaths):
+        '''
+        Deletes the files from the disk and the index, together with the
+        files belonging to them.
+        '''
+        with self._lock:
+            for filepath in filepaths:
+                self.LOG.debug('Removing old media: %s', filepath)
+                self.remove_file(filepath)
+                entry = self._files.pop(filepath, None)
+                if entry is not None:
+                    for part_filepath in entry.get('parts', ()):
+                        self.remove_file(part_filepath)
+                    self.POLICY.file_evicted(entry)
+        self.changed()
+
+    def set_references(self, filepaths):
+        '''
+        Replaces the reference counts with those of a new active playlist.
+        Files of the new playlist count as used and files of the old
+        playlist as used until now.
+        '''
+        references = {}
+        for filepath in filepaths:
+            references[filepath] = references.get(filepath, 0) + 1
+        now = time.time()
+        with self._lock:
+            for filepath in self._references:
+                if filepath in self._files:
+                    self._files[filepath]['last_use'] = now
+            for filepath in references:
+                if filepath in self._files:
+                    self._use(filepath, now)
+            self._references = references
+            if references and set(references) not in self._history[:1]:
+                self._history.insert(0, set(references))
+                del self._history[self.HISTORY_LENGTH:]
+        self.changed()
+
+    @contextmanager
+    def downloading(self, filepaths):
+        '''
+        Protects the partial files of a download while it runs. Partial files
+        left behind by a failed download are indexed as one entry keyed on
+        the first of them so that they are removed together later. The
+        others are removed if the first one is gone.
+        '''
+        partial_filepath = filepaths[0]
+        with self._lock:
+            self._downloading.add(partial_filepath)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._downloading.discard(partial_filepath)
+                for filepath in filepaths[1:]:
+                    # Entries of files indexed separately by older versions
+                    self._files.pop(filepath, None)
+                if os.path.isfile(partial_filepath):
+                    entry = self.new_entry(os.path.getsize(partial_filepath), time.time())
+                    for filepath in filepaths[1:]:
+                        if os.path.isfile(filepath):
+                            self.add_part(entry, filepath)
+                    self._files[partial_filepath] = entry
+                    self._protect(partial_filepath)
+                else:
+                    self._files.pop(partial_filepath, None)
+                    for filepath in filepaths[1:]:
+                        self.remove_file(filepath)
+            self.changed()
+
+    def eviction_candidates(self):
+        '''
+        Yields (filepath, size) of the unused files in the order given by the
+        eviction policy. The heap is built on every call: this is only needed
+        when space runs out, and the priorities of some policies (history)
+        change without any file being used.
+        '''
+        with self._lock:
+            heap = [
+                (self.POLICY.priority(filepath, entry), filepath, entry['size'])
+                for filepath, entry in self._files.iteritems()
+                if filepath not in self._references and filepath not in self._downloading and
+                not any(filepath in protected for protected in self._protected)
+            ]
+        heapq.heapify(heap)
+        while heap:
+            priority, filepath, size = heapq.heappop(heap)
+            yield filepath, size
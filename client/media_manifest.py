@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+from contextlib import contextmanager
+from threading import Lock
+
+
+class MediaManifest(object):
+    '''
+    A persistent index of downloaded media keyed by URL. Each entry stores
+    the local filename and path, expected MD5 and size, the ETag and
+    Last-Modified validators from the server and whether the download
+    has been completed.
+    The manifest is rewritten atomically after every change, or inside
+    batch() once when the batch ends. A download whose entry was not saved
+    before a power loss is still found by its filename and resumed.
+    Entries are removed when the media cleaner removes their files.
+    '''
+    LOG = logging.getLogger(__name__)
+
+    def __init__(self, manifest_filepath):
+        self.MANIFEST_FILEPATH = manifest_filepath
+        self._lock = Lock()
+        self._entries = self.load()
+        # Saving is deferred while batches are open
+        self._batch_depth = 0
+        self._dirty = False
+
+    def load(self):
+        if not os.path.isfile(self.MANIFEST_FILEPATH):
+            return {}
+        try:
+            with open(self.MANIFEST_FILEPATH, 'r') as manifest_file:
+                return json.loads(manifest_file.read())
+        except Exception, e:
+            self.LOG.error('Media manifest corrupted, starting a new one: %s', e)
+            return {}
+
+    def save(self):
+        self._dirty = False
+        tmp_filepath = self.MANIFEST_FILEPATH + '.tmp'
+        with open(tmp_filepath, 'w') as manifest_file:
+            manifest_file.write(json.dumps(self._entries))
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.rename(tmp_filepath, self.MANIFEST_FILEPATH)
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            return dict(entry) if entry else None
+
+    def update(self, url, **fields):
+        with self._lock:
+            self._entries.setdefault(url, {}).update(fields)
+            self.changed()
+
+    def remove(self, url):
+        with self._lock:
+            if self._entries.pop(url, None) is not None:
+                self.changed()
+
+    def remove_paths(self, filepaths):
+        '''
+        Removes the entries of removed files, complete or partial.
+        '''
+        filepaths = set(filepaths)
+        with self._lock:
+            urls = [
+                url for url, entry in self._entries.iteritems()
+                if entry.get('path') in filepaths or entry.get('path', '') + '.incomplete' in filepaths
+            ]
+            for url in urls:
+                del self._entries[url]
+            if urls:
+                self.LOG.debug('Removed %s manifest entries', len(urls))
+                self.changed()
+
+    def changed(self):
+        '''
+        Called with the lock held. Saves the manifest unless a batch is open.
+        '''
+        self._dirty = True
+        if not self._batch_depth:
+            self.save()
+
+    @contextmanager
+    def batch(self):
+        '''
+        Defers saving the changes made by any thread until the outermost
+        batch ends.
+        '''
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if not self._batch_depth and self._dirty:
+                    self.save()
+
+    @staticmethod
+    def is_available(entry):
+        '''
+        Whether the completed file of the entry is still on the disk.
+        '''
+        return \
+            entry.get('complete', False) and \
+            os.path.isfile(entry['path']) and \
+            os.path.getsize(entry['path']) == entry['size']
+
+    @staticmethod
+    def validator_headers(entry):
+        '''
+        Returns the headers for a conditional request revalidating the entry.
+        '''
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
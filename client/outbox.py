@@ -0,0 +1,189 @@
+import json
+import logging
+import sqlite3
+from threading import Lock
+
+
+class Outbox(object):
+    '''
+    A durable queue of messages waiting to be sent to the server, stored in
+    an SQLite database. Messages have a kind and a JSON payload and are read
+    in the order they were added.
+    The database is in WAL mode with synchronous=NORMAL: adding a message
+    does not wait for the disk, the log is synced in batches at checkpoints,
+    and a crash or power loss never corrupts the database.
+    Messages are kept in max_records slots created in advance, so the
+    database does not grow. A new message takes a free slot. When there is
+    none, it overwrites the oldest message and the number of overwritten
+    messages is counted. Messages of kinds that must not be lost are never
+    overwritten.
+    A message added with a key is merged into the unsent message with the
+    same key, if there is one.
+    '''
+
+    LOG = logging.getLogger(__name__)
+    JOURNAL_SIZE_LIMIT = 1024 * 1024  # bytes
+
+    def __init__(self, filepath, max_records=1000, compactable_kinds=()):
+        self.MAX_RECORDS = max_records
+        self.COMPACTABLE_KINDS = frozenset(compactable_kinds)
+        self._lock = Lock()
+        # Slots of messages being sent, these are not merged into
+        self._in_flight = set()
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._connection.execute('PRAGMA journal_size_limit = %d' % self.JOURNAL_SIZE_LIMIT)
+        with self._connection:
+            # seq is NULL for empty slots
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS ring ('
+                'slot INTEGER PRIMARY KEY, '
+                'seq INTEGER, '
+                'kind TEXT, '
+                'key TEXT, '
+                'payload TEXT)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS ring_key ON ring (key)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS ring_seq ON ring (seq)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+            self._connection.execute("INSERT OR IGNORE INTO counters VALUES ('next_seq', 0)")
+            self._connection.execute("INSERT OR IGNORE INTO counters VALUES ('omitted', 0)")
+            self._resize()
+            self._next_seq = self._get_counter('next_seq')
+            self._count = self._connection.execute('SELECT COUNT(*) FROM ring WHERE seq IS NOT NULL').fetchone()[0]
+        self.LOG.debug('Outbox %s has %s messages', filepath, self._count)
+
+    def _resize(self):
+        slots = self._connection.execute('SELECT COUNT(*) FROM ring').fetchone()[0]
+        if slots < self.MAX_RECORDS:
+            self._connection.executemany(
+                'INSERT INTO ring (slot) VALUES (?)',
+                [(slot,) for slot in xrange(slots, self.MAX_RECORDS)]
+            )
+        elif slots > self.MAX_RECORDS:
+            # Keeps the messages that must not be lost and then the newest
+            rows = self._connection.execute(
+                'SELECT seq, kind, key, payload FROM ring WHERE seq IS NOT NULL').fetchall()
+            rows.sort(key=lambda row: (row[1] in self.COMPACTABLE_KINDS, -row[0]))
+            kept = rows[:self.MAX_RECORDS]
+            self._add_counter('omitted', len(rows) - len(kept))
+            self._connection.execute('DELETE FROM ring')
+            self._connection.executemany(
+                'INSERT INTO ring (slot, seq, kind, key, payload) VALUES (?, ?, ?, ?, ?)',
+                [(slot,) + row for slot, row in enumerate(kept)]
+            )
+            self._connection.executemany(
+                'INSERT INTO ring (slot) VALUES (?)',
+                [(slot,) for slot in xrange(len(kept), self.MAX_RECORDS)]
+            )
+
+    def _get_counter(self, name):
+        return self._connection.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()[0]
+
+    def _add_counter(self, name, amount):
+        self._connection.execute('UPDATE counters SET value = value + ? WHERE name = ?', (amount, name))
+
+    def append(self, kind, payload, replace=False, key=None, merge=None):
+        '''
+        Adds a message to the end of the outbox.
+        :param replace: Whether the message replaces earlier messages of the
+            same kind, e.g. a newer playlist confirmation
+        :param key: Messages with the same key are merged while unsent
+        :param merge: A function given the unsent payload and the new one
+            returning the merged payload
+        '''
+        with self._lock:
+            with self._connection:
+                if key is not None and self._merge(kind, key, payload, merge):
+                    return
+                if replace:
+                    cursor = self._connection.execute(
+                        'UPDATE ring SET seq = NULL, kind = NULL, key = NULL, payload = NULL '
+                        'WHERE kind = ? AND seq IS NOT NULL', (kind,))
+                    self._count -= cursor.rowcount
+                self._insert(kind, key, json.dumps(payload))
+
+    def _merge(self, kind, key, payload, merge):
+        rows = self._connection.execute(
+            'SELECT slot, payload FROM ring WHERE key = ? AND kind = ? AND seq IS NOT NULL', (key, kind)
+        ).fetchall()
+        for slot, old_payload in rows:
+            if slot in self._in_flight:
+                continue
+            merged = merge(json.loads(old_payload), payload)
+            self._connection.execute('UPDATE ring SET payload = ? WHERE slot = ?', (json.dumps(merged), slot))
+            return True
+        return False
+
+    def _insert(self, kind, key, data):
+        row = self._connection.execute('SELECT slot FROM ring WHERE seq IS NULL LIMIT 1').fetchone()
+        if row is not None:
+            self._count += 1
+        else:
+            row = self._connection.execute(
+                'SELECT slot FROM ring WHERE kind IN ({0}) ORDER BY seq LIMIT 1'.format(
+                    ', '.join('?' * len(self.COMPACTABLE_KINDS))),
+                tuple(self.COMPACTABLE_KINDS)
+            ).fetchone() if self.COMPACTABLE_KINDS else None
+            if row is None:
+                self.LOG.error('Outbox full of messages that cannot be overwritten, dropped a message')
+                return
+            self._add_counter('omitted', 1)
+            self._in_flight.discard(row[0])
+        seq = self._next_seq
+        self._next_seq += 1
+        self._connection.execute(
+            'UPDATE ring SET seq = ?, kind = ?, key = ?, payload = ? WHERE slot = ?',
+            (seq, kind, key, data, row[0])
+        )
+        self._connection.execute("UPDATE counters SET value = ? WHERE name = 'next_seq'", (self._next_seq,))
+
+    def peek(self, kind, limit):
+        '''
+        Returns the oldest messages of the kind. They are not merged into
+        until removed or released.
+        :return: A list of (message id, payload)
+        '''
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT slot, seq, payload FROM ring WHERE kind = ? AND seq IS NOT NULL ORDER BY seq LIMIT ?',
+                (kind, limit)
+            ).fetchall()
+            self._in_flight.update(slot for slot, _, _ in rows)
+        return [((slot, seq), json.loads(payload)) for slot, seq, payload in rows]
+
+    def remove(self, ids):
+        '''
+        Removes sent messages.
+        '''
+        if not ids:
+            return
+        with self._lock:
+            with self._connection:
+                cursor = self._connection.executemany(
+                    'UPDATE ring SET seq = NULL, kind = NULL, key = NULL, payload = NULL '
+                    'WHERE slot = ? AND seq = ?', ids)
+                self._count -= cursor.rowcount
+            self._in_flight.difference_update(slot for slot, _ in ids)
+
+    def release(self, ids):
+        '''
+        Returns messages that could not be sent to the outbox.
+        '''
+        with self._lock:
+            self._in_flight.difference_update(slot for slot, _ in ids)
+
+    def count(self):
+        return self._count
+
+    def take_omitted(self):
+        '''
+        :return: The number of messages overwritten since the last call
+        '''
+        with self._lock:
+            with self._connection:
+                omitted = self._get_counter('omitted')
+                if omitted:
+                    self._connection.execute("UPDATE counters SET value = 0 WHERE name = 'omitted'")
+        return omitted
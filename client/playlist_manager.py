@@ -2,33 +2,54 @@ import json
 import logging
 import os
 from ast import literal_eval
+from collections import namedtuple
+from threading import Lock
 from urlparse import urljoin
-import requests
 
 from display.media import Media
-from downloader import ChunkedDownloader
+from downloader import ChunkedDownloader, DownloadCancelled
 from media_cleaner import MediaCleaner
+from media_manifest import MediaManifest
+from playlist_parser import PlaylistJsonParser
+from config_utils import get_option
+from display.timing import monotonic
 
 
 class PlaylistNotChanged(Exception):
     pass
 
 
+class PlaylistDownloadError(Exception):
+    '''
+    Raised when one or more files of a playlist could not be downloaded.
+    The failures attribute maps the URL of each failed file to its exception.
+    '''
+    def __init__(self, failures):
+        self.failures = failures
+        super(PlaylistDownloadError, self).__init__(
+            'Failed to download {0} file(s): {1}'.format(
+                len(failures),
+                '; '.join('{0} ({1})'.format(url, e) for url, e in failures.iteritems())
+            )
+        )
+
+
+# A playlist fetched from the server whose files may not be downloaded yet.
+# validators are the (ETag, Last-Modified) of the response.
+FetchedPlaylist = namedtuple('FetchedPlaylist', [
+    'media_url', 'playlist', 'playlist_id', 'playlist_update_time', 'validators'
+])
+
+
 class PlaylistManager(object):
     LOG = logging.getLogger(__name__)
     SCHEDULE_NAME_STRING = 'media_schedule_json'
-    SCHEDULE_TIME_STRING = 'time'
-    SCHEDULE_TYPE_STRING = 'media_type'
-    SCHEDULE_URI_STRING = 'url'
     SCHEDULE_MEDIA_URL = 'media_url'
     PLAYLIST_ID = 'id'
     PLAYLIST_UPDATE_TIME_STRING = 'updated'
 
-    def __init__(self, config):
-        # Device ID
-        device_id_file = open(config.get('Device', 'device_id_file'), 'r')
-        self.DEVICE_ID = device_id_file.read().strip()
-        device_id_file.close()
+    def __init__(self, config, http_session):
+        self.HTTP_SESSION = http_session
 
         # Playlist URL
         server_url = config.get('Server', 'server_url')
@@ -59,18 +80,59 @@ class PlaylistManager(object):
         if playlist_connection_timeout == 0:
             playlist_connection_timeout = None
         self.PLAYLIST_TIMEOUTS = (playlist_bytes_timeout, playlist_connection_timeout)
+        # Time limits for a whole request, the above limit single waits
+        self.PLAYLIST_DEADLINE = int(get_option(config, 'Client', 'playlist_total_timeout', 120)) or None
+        download_deadline = int(get_option(config, 'Client', 'download_total_timeout', 0)) or None
+        self.DOWNLOAD_WORKERS = int(get_option(config, 'Client', 'download_workers', 3))
+        # A playlist whose files failed to download is downloaded again
+        # after a backoff doubling from the poll time to the maximum poll time
+        self.MIN_DOWNLOAD_BACKOFF = config.getfloat('Client', 'playlist_poll_time')
+        self.MAX_DOWNLOAD_BACKOFF = max(self.MIN_DOWNLOAD_BACKOFF,
+                                        float(get_option(config, 'Client', 'playlist_max_poll_time', 900)))
+
+        # Index of downloaded media, kept next to the playlist file so that
+        # the media cleaner does not consider it unused media
+        manifest_file = get_option(config, 'Storage', 'media_manifest_file',
+                                   os.path.join(playlist_folder, 'media_manifest.json'))
+        self.manifest = MediaManifest(manifest_file)
 
-        media_cleaner = MediaCleaner(config, self.PLAYLIST_PARSER)
+        # Index of the media folder for the media cleaner
+        media_index_file = get_option(config, 'Storage', 'media_index_file',
+                                      os.path.join(playlist_folder, 'media_index.json'))
+        self.media_cleaner = MediaCleaner(config, self.PLAYLIST_PARSER, media_index_file, self.manifest)
+
+        revalidate_media = int(get_option(config, 'Client', 'revalidate_media', 1)) != 0
+        download_segments = int(get_option(config, 'Client', 'download_segments', 4))
+        segmented_min_mb = int(get_option(config, 'Client', 'segmented_download_min_mb', 50))
 
         # Utility for downloading files
-        self.downloader = ChunkedDownloader(server_url,
-                                            self.DEVICE_ID,
+        self.downloader = ChunkedDownloader(http_session,
                                             self.MEDIA_FOLDER,
                                             self.PLAYLIST_TIMEOUTS,
-                                            media_cleaner)
+                                            self.media_cleaner,
+                                            self.manifest,
+                                            revalidate_media,
+                                            download_segments,
+                                            segmented_min_mb * 1000 * 1000,
+                                            download_deadline)
 
         self.playlist_id = None
         self.playlist_update_time = None
+        # Validators of the playlist currently in use and of the fetched one
+        self.playlist_validators = (None, None)
+        self.fetched_validators = (None, None)
+        # The FetchedPlaylist whose files are being downloaded
+        self.pending_playlist = None
+        self._pending_lock = Lock()
+        # Only one playlist is downloaded at a time
+        self._download_lock = Lock()
+        # (playlist_id, playlist_update_time) of the playlist whose download
+        # failed, the number of failures and when to try again
+        self._failed_playlist = None
+        self._download_failures = 0
+        self._download_retry_time = 0
+        # Headers of the latest playlist response, used for poll scheduling
+        self.last_response_headers = {}
 
     def fetch_local_playlist(self):
         try:
@@ -84,34 +146,132 @@ class PlaylistManager(object):
             self.LOG.info('No locally stored playlist')
             return []
 
-    def fetch_remote_playlist_data(self):
+    def fetch_remote_playlist_data(self, wait=None):
+        '''
+        Fetches the playlist JSON. If wait is given, the server is asked to
+        hold the request open for up to wait seconds until the playlist
+        changes (long polling).
+        '''
         url = self.PLAYLIST_URL
-        headers = {'Authorization': 'Device %s' % self.DEVICE_ID}
+        headers = {'Accept-Encoding': 'gzip'}
+        # While a playlist is downloaded, only a newer one is of interest
+        pending_playlist = self.pending_playlist
+        if pending_playlist is not None:
+            etag, last_modified = pending_playlist.validators
+        else:
+            etag, last_modified = self.playlist_validators
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        params = None
+        timeout = (60, 60)
+        deadline = self.PLAYLIST_DEADLINE
+        if wait:
+            params = {'wait': wait}
+            timeout = (60, 60 + wait)
+            if deadline:
+                deadline += wait
         self.LOG.debug('Fetching remote playlist from %s' % url)
-        response = requests.get(
+        self.last_response_headers = {}
+        response = self.HTTP_SESSION.get(
                 url,
-                timeout=(60, 60),
+                timeout=timeout,
                 stream=False,
-                headers=headers)
+                headers=headers,
+                params=params,
+                deadline=deadline,
+                measure_latency=not wait)
+        self.last_response_headers = response.headers
 
+        if response.status_code == 304:
+            raise PlaylistNotChanged("Playlist not modified on the server")
         if response.status_code == 200:
             self.LOG.debug('Fetched data: %s' % response.content)
+            self.fetched_validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
             return response.content
         raise Exception('Wrong status from server while fetching playlist: %s' % response.status_code)
 
-    def fetch_playlist(self):
-        pl_data = self.fetch_remote_playlist_data()
+    def fetch_playlist(self, wait=None):
+        '''
+        Fetches the playlist without downloading its files.
+        :return: A FetchedPlaylist to pass to download_playlist()
+        :raises PlaylistNotChanged: if the playlist is the one in use or the
+            one being downloaded
+        '''
+        pl_data = self.fetch_remote_playlist_data(wait)
         if pl_data is None:
             raise Exception("No playlist data received from server.")
 
         media_url, playlist, playlist_id, playlist_update_time = self.parse_playlist(pl_data)
-        if self.playlist_id == playlist_id and self.playlist_update_time == playlist_update_time:
-            raise PlaylistNotChanged("Playlist data has not changed since last downloaded")
-        self.playlist_id = playlist_id
-        self.playlist_update_time = playlist_update_time
-        self.download_playlist_files(playlist, media_url)
-        self.PLAYLIST_PARSER.save_playlist_to_file(playlist)
-        return playlist, playlist_id, playlist_update_time
+        fetched = FetchedPlaylist(media_url, playlist, playlist_id, playlist_update_time, self.fetched_validators)
+        with self._pending_lock:
+            if self.is_current(fetched):
+                self.playlist_validators = self.fetched_validators
+                raise PlaylistNotChanged("Playlist data has not changed since last downloaded")
+            pending_playlist = self.pending_playlist
+            if pending_playlist is not None and \
+                    pending_playlist.playlist_id == playlist_id and \
+                    pending_playlist.playlist_update_time == playlist_update_time:
+                raise PlaylistNotChanged("Playlist is already being downloaded")
+            retry_delay = self._download_retry_time - monotonic()
+            if self._failed_playlist == (playlist_id, playlist_update_time) and retry_delay > 0:
+                raise PlaylistNotChanged("Downloading the playlist failed, trying again in {0:.0f}s".format(retry_delay))
+            self.pending_playlist = fetched
+        return fetched
+
+    def is_current(self, fetched):
+        return self.playlist_id == fetched.playlist_id and \
+            self.playlist_update_time == fetched.playlist_update_time
+
+    def download_playlist(self, fetched, cancelled=None):
+        '''
+        Downloads the files of a fetched playlist and takes it into use.
+        :param cancelled: An Event set when a newer playlist has been fetched
+        :return: A tuple (playlist, playlist_id, playlist_update_time)
+        :raises DownloadCancelled: if cancelled was set before the playlist
+            was taken into use
+        '''
+        try:
+            with self._download_lock:
+                if cancelled is not None and cancelled.is_set():
+                    raise DownloadCancelled('Playlist {0} superseded'.format(fetched.playlist_id))
+                if self.is_current(fetched):
+                    raise PlaylistNotChanged("Playlist data has not changed since last downloaded")
+                playlist = self.download_playlist_files(fetched.playlist, fetched.media_url, cancelled)
+                # Remember the playlist only after its files are downloaded so
+                # that a failed download is retried on the next poll
+                self.playlist_id = fetched.playlist_id
+                self.playlist_update_time = fetched.playlist_update_time
+                self.playlist_validators = fetched.validators
+                self.PLAYLIST_PARSER.save_playlist_to_file(playlist)
+                self.media_cleaner.playlist_activated(playlist)
+                with self._pending_lock:
+                    self._failed_playlist = None
+                return playlist, fetched.playlist_id, fetched.playlist_update_time
+        except (DownloadCancelled, PlaylistNotChanged):
+            raise
+        except Exception:
+            with self._pending_lock:
+                self.download_failed(fetched)
+            raise
+        finally:
+            with self._pending_lock:
+                if self.pending_playlist is fetched:
+                    self.pending_playlist = None
+
+    def download_failed(self, fetched):
+        playlist_key = (fetched.playlist_id, fetched.playlist_update_time)
+        if self._failed_playlist == playlist_key:
+            self._download_failures += 1
+        else:
+            self._failed_playlist = playlist_key
+            self._download_failures = 1
+        backoff = min(self.MAX_DOWNLOAD_BACKOFF,
+                      self.MIN_DOWNLOAD_BACKOFF * 2 ** min(self._download_failures - 1, 16))
+        self._download_retry_time = monotonic() + backoff
+        self.LOG.info('Downloading playlist %s failed %s times, trying again in %.0fs',
+                      fetched.playlist_id, self._download_failures, backoff)
 
     def parse_playlist(self, pl_data):
         self.LOG.debug("Parsing playlist")
@@ -127,68 +287,38 @@ class PlaylistManager(object):
         playlist_update_time = playlist_dl[PlaylistManager.PLAYLIST_UPDATE_TIME_STRING]
         media_url = playlist_dl[PlaylistManager.SCHEDULE_MEDIA_URL]
         media_schedule = literal_eval(playlist_dl[PlaylistManager.SCHEDULE_NAME_STRING])
-        media_schedule = self.generate_viewer_playlist(media_schedule)
+        media_schedule = self.PLAYLIST_PARSER.generate_viewer_playlist(media_schedule)
         self.LOG.debug('Media schedule %s', media_schedule)
         return media_url, media_schedule, playlist_id, playlist_update_time
 
-    def generate_viewer_playlist(self, playlist):
-        viewer_pl = []
-        for content in playlist:
-            self.LOG.debug("Generating playlist for content: %s", content)
-            content_type = content[PlaylistManager.SCHEDULE_TYPE_STRING]
-            content_uri = content[PlaylistManager.SCHEDULE_URI_STRING]
-            view_time = int(content[PlaylistManager.SCHEDULE_TIME_STRING])
-            media = Media(content_type, content_uri, view_time)
-            viewer_pl.append(media)
-        return viewer_pl
-
-    # NOTE: Also sets content_uri to local uri
-    def download_playlist_files(self, playlist, own_server_media_url):
+    def download_playlist_files(self, playlist, own_server_media_url, cancelled=None):
+        '''
+        :param cancelled: An Event that stops the downloads when set
+        :return: The playlist with the local paths of the downloaded files
+        '''
         self.downloader.set_hisra_net_loc(own_server_media_url)
+        # Web pages are not downloaded
+        files = [content for content in playlist if content.content_type != Media.WEB_PAGE]
+        # The media index and manifest are saved once for the whole playlist
+        with self.media_cleaner.batch(), self.manifest.batch():
+            # Make space for the whole playlist before downloading anything.
+            # Without the size of every file the space cannot be planned.
+            required_bytes, local_filepaths, failures = self.downloader.plan_download(files, self.DOWNLOAD_WORKERS)
+            if failures:
+                raise PlaylistDownloadError(failures)
+            self.LOG.debug('Playlist needs %s more bytes', required_bytes)
+            # Files of the playlist already on the disk or downloaded by it
+            # must survive the cleanups of its later downloads
+            with self.media_cleaner.protecting(local_filepaths):
+                self.media_cleaner.plan_space(required_bytes)
+                local_paths, failures = self.downloader.download_all(files, self.DOWNLOAD_WORKERS, cancelled)
+        if cancelled is not None and cancelled.is_set():
+            raise DownloadCancelled('Playlist download cancelled')
+        if failures:
+            raise PlaylistDownloadError(failures)
+        downloaded_playlist = []
         for content in playlist:
-            if content.content_type == Media.WEB_PAGE:
-                continue  # Web pages are not downloaded
-            try:
-                content.content_uri = self.downloader.download(content)
-            except Exception, e:
-                self.LOG.debug('Failed to download content, %s %s', content, e.message)
-                raise
-
-
-class PlaylistJsonParser(object):
-    LOG = logging.getLogger(__name__)
-
-    def __init__(self, playlist_filepath):
-        self.PLAYLIST_FILEPATH = playlist_filepath
-
-    def parse_playlist_json(self, pl_json):
-        playlist = json.loads(pl_json)
-        return self.generate_viewer_playlist(playlist)
-
-    def get_stored_playlist(self):
-        with open(self.PLAYLIST_FILEPATH, 'r') as pl_file:
-            playlist_json = pl_file.read()
-        return self.parse_playlist_json(playlist_json)
-
-    def generate_viewer_playlist(self, playlist):
-        viewer_pl = []
-        for content in playlist:
-            content_type = content[PlaylistManager.SCHEDULE_TYPE_STRING]
-            content_uri = content[PlaylistManager.SCHEDULE_URI_STRING]
-            view_time = int(content[PlaylistManager.SCHEDULE_TIME_STRING])
-            media = Media(content_type, content_uri, view_time)
-            viewer_pl.append(media)
-        return viewer_pl
-
-    def save_playlist_to_file(self, playlist):
-        self.LOG.debug('Saving playlist to file')
-        json_playlist = []
-        for content in playlist:
-            json_content = {}
-            json_content[PlaylistManager.SCHEDULE_TYPE_STRING] = content.content_type
-            json_content[PlaylistManager.SCHEDULE_URI_STRING] = content.content_uri
-            json_content[PlaylistManager.SCHEDULE_TIME_STRING] = content.view_time
-            json_playlist.append(json_content)
-        with open(self.PLAYLIST_FILEPATH, 'w') as pl_file:
-            pl_file.write(json.dumps(json_playlist))
-        self.LOG.debug("Playlist saved")
+            if content.content_type != Media.WEB_PAGE:
+                content = content.with_local_path(local_paths[content.content_uri])
+            downloaded_playlist.append(content)
+        return downloaded_playlist
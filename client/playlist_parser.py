@@ -0,0 +1,55 @@
+import json
+import logging
+
+from display.media import Media
+
+
+class PlaylistJsonParser(object):
+    '''
+    Converts playlists between JSON and lists of Media and stores the
+    playlist in use on the disk. Has no network dependencies, so the stored
+    playlist can be read before the rest of the client is imported.
+    '''
+    LOG = logging.getLogger(__name__)
+    SCHEDULE_TIME_STRING = 'time'
+    SCHEDULE_TYPE_STRING = 'media_type'
+    SCHEDULE_URI_STRING = 'url'
+    # Local path of downloaded content, only in the stored playlist
+    SCHEDULE_PATH_STRING = 'path'
+
+    def __init__(self, playlist_filepath):
+        self.PLAYLIST_FILEPATH = playlist_filepath
+
+    def parse_playlist_json(self, pl_json):
+        playlist = json.loads(pl_json)
+        return self.generate_viewer_playlist(playlist)
+
+    def get_stored_playlist(self):
+        with open(self.PLAYLIST_FILEPATH, 'r') as pl_file:
+            playlist_json = pl_file.read()
+        return self.parse_playlist_json(playlist_json)
+
+    def generate_viewer_playlist(self, playlist):
+        type_key = PlaylistJsonParser.SCHEDULE_TYPE_STRING
+        uri_key = PlaylistJsonParser.SCHEDULE_URI_STRING
+        time_key = PlaylistJsonParser.SCHEDULE_TIME_STRING
+        path_key = PlaylistJsonParser.SCHEDULE_PATH_STRING
+        return [
+            Media(content[type_key], content[uri_key], int(content[time_key]), content.get(path_key))
+            for content in playlist
+        ]
+
+    def save_playlist_to_file(self, playlist):
+        self.LOG.debug('Saving playlist to file')
+        json_playlist = []
+        for content in playlist:
+            json_content = {}
+            json_content[PlaylistJsonParser.SCHEDULE_TYPE_STRING] = content.content_type
+            json_content[PlaylistJsonParser.SCHEDULE_URI_STRING] = content.content_uri
+            json_content[PlaylistJsonParser.SCHEDULE_TIME_STRING] = content.view_time
+            if content.local_path is not None:
+                json_content[PlaylistJsonParser.SCHEDULE_PATH_STRING] = content.local_path
+            json_playlist.append(json_content)
+        with open(self.PLAYLIST_FILEPATH, 'w') as pl_file:
+            pl_file.write(json.dumps(json_playlist))
+        self.LOG.debug("Playlist saved")
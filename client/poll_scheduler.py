@@ -0,0 +1,105 @@
+import logging
+import random
+import re
+import time
+from threading import Lock
+from email.utils import parsedate_tz, mktime_tz
+
+
+class PollScheduler(object):
+    '''
+    Decides how long to wait before the next playlist poll.
+    The interval is backed off exponentially while polls fail and follows
+    the Cache-Control max-age of the server when given. The interval is
+    never shorter than MIN_INTERVAL_FACTOR times the configured interval, so
+    a server saying max-age=0 does not make every device poll constantly.
+    A Retry-After header delays the next poll at least that long, but not
+    longer than the maximum interval. Every delay is
+    randomized by JITTER so that devices that started at the same time do
+    not keep polling in sync.
+    '''
+
+    LOG = logging.getLogger(__name__)
+    JITTER = 0.2  # fraction of the interval
+    INITIAL_SPREAD = 0.5  # fraction of the interval to wait before the first poll
+    MIN_INTERVAL = 1  # seconds
+    MIN_INTERVAL_FACTOR = 0.5  # fraction of the base interval
+    NO_CACHE_DIRECTIVES = ('no-cache', 'no-store')
+    MAX_AGE_PATTERN = re.compile(r'max-age=(\d+)')
+
+    def __init__(self, base_interval, max_interval):
+        self.base_interval = float(base_interval)
+        self.max_interval = float(max(max_interval, base_interval))
+        self.interval = self.base_interval
+        self.error_count = 0
+        self.retry_after = 0
+        # Polls and their callbacks run on several executor threads
+        self._lock = Lock()
+
+    def initial_delay(self):
+        return random.uniform(0, self.base_interval * self.INITIAL_SPREAD)
+
+    def next_delay(self):
+        with self._lock:
+            delay = self.interval * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+            return max(delay, self.retry_after)
+
+    def record_success(self, headers):
+        '''
+        Called after a successful poll with the response headers.
+        :return: Whether the interval changed
+        '''
+        with self._lock:
+            self.error_count = 0
+            interval = self.base_interval
+            max_age = self.parse_max_age(headers)
+            if max_age is not None:
+                interval = max_age
+            return self.set_interval(interval, headers)
+
+    def record_error(self, headers):
+        '''
+        Called after a failed poll with the response headers, if any.
+        :return: Whether the interval changed
+        '''
+        with self._lock:
+            self.error_count += 1
+            interval = self.base_interval * 2 ** min(self.error_count, 16)
+            return self.set_interval(interval, headers)
+
+    def set_interval(self, interval, headers):
+        # Called with the lock held
+        self.retry_after = min(self.max_interval, self.parse_retry_after(headers))
+        min_interval = max(self.MIN_INTERVAL, self.base_interval * self.MIN_INTERVAL_FACTOR)
+        interval = min(self.max_interval, max(min_interval, interval))
+        changed = interval != self.interval
+        if changed:
+            self.LOG.debug('Playlist poll interval changed to %ss', interval)
+        self.interval = interval
+        return changed
+
+    def parse_max_age(self, headers):
+        '''
+        :return: The max-age of the response, None if it is not given, is 0
+            or the response must not be cached at all (no-cache, no-store),
+            as such headers say nothing about how often to poll
+        '''
+        cache_control = headers.get('Cache-Control', '').lower()
+        if any(directive in cache_control for directive in self.NO_CACHE_DIRECTIVES):
+            return None
+        match = self.MAX_AGE_PATTERN.search(cache_control)
+        if match and int(match.group(1)) > 0:
+            return int(match.group(1))
+        return None
+
+    @staticmethod
+    def parse_retry_after(headers):
+        retry_after = headers.get('Retry-After')
+        if not retry_after:
+            return 0
+        if retry_after.strip().isdigit():
+            return int(retry_after)
+        retry_time = parsedate_tz(retry_after)
+        if retry_time is None:
+            return 0
+        return max(0, mktime_tz(retry_time) - time.time())
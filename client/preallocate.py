@@ -0,0 +1,35 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+
+# Allocate blocks without changing the file size, so that the size of a
+# partial download still tells how much of it has been written
+FALLOC_FL_KEEP_SIZE = 1
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fallocate = _libc.fallocate64
+    _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    _fallocate.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _fallocate = None
+
+
+def preallocate(fileobj, offset, length):
+    '''
+    Allocates disk blocks for length bytes of the file starting at offset.
+    Running out of space is noticed immediately instead of in the middle of
+    a download and the file is not fragmented by concurrent writers.
+    :return: Whether the blocks were allocated. False if the platform or
+        file system does not support it.
+    :raises OSError: if allocation fails, e.g. with ENOSPC
+    '''
+    if _fallocate is None or length <= 0:
+        return False
+    if _fallocate(fileobj.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.EOPNOTSUPP, errno.ENOSYS):
+        return False
+    raise OSError(error, os.strerror(error))
@@ -0,0 +1,112 @@
+import logging
+import time
+from threading import Lock
+from config_utils import get_option
+
+
+class TokenBucket(object):
+    '''
+    Limits the rate at which media is downloaded. Tokens (bytes) are added
+    at the steady rate up to the burst size. Consuming more tokens than are
+    available blocks the caller until the debt has been paid back, so all
+    download threads sharing the bucket are limited together.
+    A rate of 0 means unlimited.
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._last_refill = time.time()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            wait_time = -self._tokens / self.rate
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            self.rate = float(rate)
+
+    def record_latency(self, seconds):
+        '''
+        Called with the duration of status and playlist requests.
+        The steady rate does not react to latency.
+        '''
+        pass
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    '''
+    A token bucket which lowers the download rate when status and playlist
+    requests see rising latency and raises it again towards the maximum
+    rate when the latency is back to normal (additive increase,
+    multiplicative decrease).
+    '''
+
+    LOG = logging.getLogger(__name__)
+    LATENCY_SMOOTHING = 0.3
+    BASELINE_DRIFT = 0.01
+    # Latency this many times the baseline means the link is congested
+    LATENCY_TOLERANCE = 2.0
+    DECREASE_FACTOR = 0.5
+    INCREASE_STEP = 0.1  # fraction of max rate
+
+    def __init__(self, max_rate, min_rate, burst):
+        super(AdaptiveRateLimiter, self).__init__(max_rate, burst)
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min(min_rate, max_rate))
+        self._baseline_latency = None
+        self._smoothed_latency = None
+
+    def record_latency(self, seconds):
+        # Called by every request thread
+        with self._lock:
+            if self._smoothed_latency is None:
+                self._smoothed_latency = seconds
+            else:
+                self._smoothed_latency += self.LATENCY_SMOOTHING * (seconds - self._smoothed_latency)
+            if self._baseline_latency is None or seconds < self._baseline_latency:
+                self._baseline_latency = seconds
+            else:
+                # Let the baseline follow lasting changes of the link
+                self._baseline_latency += self.BASELINE_DRIFT * (seconds - self._baseline_latency)
+
+            if self._smoothed_latency > self._baseline_latency * self.LATENCY_TOLERANCE:
+                rate = max(self.min_rate, self.rate * self.DECREASE_FACTOR)
+            else:
+                rate = min(self.max_rate, self.rate + self.max_rate * self.INCREASE_STEP)
+            if rate == self.rate:
+                return
+            self.LOG.debug('Download rate set to %s B/s, request latency %.3fs (baseline %.3fs)',
+                           rate, self._smoothed_latency, self._baseline_latency)
+            self._refill()
+            self.rate = rate
+
+
+def create_rate_limiter(config):
+    '''
+    Creates the download rate limiter configured in the Client section.
+    '''
+    rate = int(get_option(config, 'Client', 'download_rate_kbps', 0)) * 1000
+    burst = int(get_option(config, 'Client', 'download_burst_kb', 256)) * 1000
+    mode = get_option(config, 'Client', 'download_rate_mode', 'fixed')
+    if mode == 'adaptive' and rate <= 0:
+        AdaptiveRateLimiter.LOG.warning(
+            'Adaptive download rate needs download_rate_kbps as its maximum rate, downloads are unlimited')
+    elif mode == 'adaptive':
+        min_rate = int(get_option(config, 'Client', 'download_min_rate_kbps', 32)) * 1000
+        return AdaptiveRateLimiter(rate, min_rate, burst)
+    return TokenBucket(rate, burst)
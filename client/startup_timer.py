@@ -0,0 +1,49 @@
+import logging
+from display.timing import monotonic
+
+
+class StartupTimer(object):
+    '''
+    Measures how long each phase of starting the client takes and when the
+    first content was displayed, counted from the start of the client and
+    from the boot of the device.
+    '''
+
+    LOG = logging.getLogger(__name__)
+    UPTIME_FILEPATH = '/proc/uptime'
+
+    def __init__(self):
+        self.start_time = monotonic()
+        self.uptime_at_start = self.read_uptime()
+        self.phases = []
+        self._phase_start_time = self.start_time
+
+    def read_uptime(self):
+        try:
+            with open(self.UPTIME_FILEPATH, 'r') as uptime_file:
+                return float(uptime_file.read().split()[0])
+        except (IOError, ValueError, IndexError):
+            return None
+
+    def mark(self, phase):
+        '''
+        Ends the current phase and names it.
+        '''
+        now = monotonic()
+        duration = now - self._phase_start_time
+        self._phase_start_time = now
+        self.phases.append((phase, duration))
+        self.LOG.debug('Startup phase %s took %.3fs', phase, duration)
+
+    def describe(self, first_display_time=None):
+        '''
+        :param first_display_time: monotonic() time when the first content
+            was displayed, if it has been
+        '''
+        parts = ['{0} {1:.2f}s'.format(phase, duration) for phase, duration in self.phases]
+        if first_display_time is not None:
+            since_start = first_display_time - self.start_time
+            parts.append('first content {0:.2f}s'.format(since_start))
+            if self.uptime_at_start is not None:
+                parts.append('{0:.1f}s after boot'.format(self.uptime_at_start + since_start))
+        return ', '.join(parts)
@@ -1,16 +1,39 @@
 import requests
 import time
+import os
+import gzip
+import json
+import random
+from cStringIO import StringIO
 from urlparse import urljoin
+from threading import Thread, Event, Condition
 import datetime
 import logging
+from outbox import Outbox
+from config_utils import get_option
+from display.timing import monotonic, TimingStats
 
 
 class StatusMonitor(object):
     """
-    Collects status information and submits it as a batch to the server
+    Collects status information and submits it as a batch to the server.
+    Status messages and playlist confirmations are stored in an Outbox on
+    the disk until the server has accepted them, so they survive lost
+    connections and restarts.
+    Messages are sent by a background thread, so adding them never waits for
+    the network. Status messages are sent when FLUSH_SIZE of them are
+    waiting, when the oldest has waited FLUSH_MAX_AGE seconds or when a
+    flush is requested. Failed sends are retried with exponential backoff.
     """
 
     LOG = logging.getLogger(__name__)
+    STATUS = 'status'
+    CONFIRMATION = 'confirmation'
+    BATCH_SIZE = 50
+    MIN_BACKOFF = 5  # seconds
+    MAX_BACKOFF = 600  # seconds
+    # Responses to a compressed body telling that the server cannot read it
+    COMPRESSION_REJECTED_CODES = (400, 415)
 
     class EventTypes:
         ERROR = 0
@@ -18,18 +41,20 @@ class StatusMonitor(object):
 
     class Categories:
         CONNECTION = 'Connection'
+        POLLING = 'Polling'
+        CACHE = 'Cache'
+        STORAGE = 'Storage'
+        DISPLAY = 'Display'
+        STARTUP = 'Startup'
         OMITTED_STATUSES = 'Omitted'
 
-    def __init__(self, config):
+    def __init__(self, config, http_session):
+        self.http_session = http_session
         server_url = config.get('Server', 'server_url')
         playlist_server_path = config.get('Server', 'playlist_server_path')
         status_server_path = config.get('Server', 'status_server_path')
         self.status_url = urljoin(server_url, status_server_path)
         self.confirm_pl_url = urljoin(server_url, playlist_server_path)
-        # Device ID
-        device_id_file = open(config.get('Device', 'device_id_file'), 'r')
-        device_id = device_id_file.read().strip()
-        device_id_file.close()
 
         status_connection_timeout = int(config.get('Client', 'status_connection_timeout'))
         if status_connection_timeout == 0:
@@ -38,34 +63,201 @@ class StatusMonitor(object):
         if status_bytes_timeout == 0:
             status_bytes_timeout = None
         self.timeouts = (status_bytes_timeout, status_connection_timeout)
+        # Time limit for a whole request, the above limit single waits
+        self.DEADLINE = int(get_option(config, 'Client', 'status_total_timeout', 120)) or None
 
-        self.status_list = []
-        self.headers = {'Authorization':'Device {0}'.format(device_id)}
+        playlist_folder = os.path.dirname(config.get('Storage', 'playlist_file'))
+        outbox_file = get_option(config, 'Storage', 'outbox_file', os.path.join(playlist_folder, 'outbox.db'))
+        outbox_max_records = int(get_option(config, 'Storage', 'outbox_max_records', 1000))
+        # Confirmations are never overwritten, a newer one replaces them instead
+        self.outbox = Outbox(outbox_file, outbox_max_records, compactable_kinds=(self.STATUS,))
+
+        self.FLUSH_SIZE = int(get_option(config, 'Client', 'status_flush_size', self.BATCH_SIZE))
+        self.FLUSH_MAX_AGE = float(get_option(config, 'Client', 'status_flush_max_age', 60))
+        self.compress = get_option(config, 'Client', 'status_compression', 'gzip') == 'gzip'
+        # Guards _wakeup, _flush_requested and _oldest_pending_time, which
+        # are shared by the threads adding messages and the sender thread
+        self._condition = Condition()
+        self._wakeup = False
+        self._stop = Event()
+        self._flush_requested = False
+        # When the oldest status message not yet picked by the sender was added
+        self._oldest_pending_time = monotonic() if self.outbox.count() else None
+        self._failures = 0
+        self._retry_time = 0
+        self.sender_thread = None
+
+        # Metrics
+        self.batch_sizes = TimingStats()
+        self.send_latency = TimingStats()
+        self.sent_messages = 0
+        self.failed_sends = 0
+        self.uncompressed_bytes = 0
+        self.sent_bytes = 0
+
+    def start(self):
+        '''
+        Starts the thread that sends the messages in the outbox.
+        '''
+        def sender_worker():
+            while not self._stop.is_set():
+                try:
+                    with self._condition:
+                        if not self._wakeup:
+                            self._condition.wait(self.time_to_next_send())
+                        self._wakeup = False
+                        send = not self._stop.is_set() and self.should_send()
+                        if send:
+                            # Messages added from now on start a new wait
+                            self._flush_requested = False
+                            self._oldest_pending_time = None
+                    if send:
+                        self.send_pending()
+                except Exception:
+                    self.LOG.exception('Status sender failed')
+                    self._stop.wait(self.MIN_BACKOFF)
+
+        self.sender_thread = Thread(target=sender_worker)
+        self.sender_thread.daemon = True
+        self.sender_thread.start()
+
+    def shutdown(self):
+        self._stop.set()
+        self.wake_up()
+
+    def wake_up(self):
+        with self._condition:
+            self._wakeup = True
+            self._condition.notify()
 
     def submit_collected_events(self):
-        if len(self.status_list) == 0:
-            return None
-        if len(self.status_list) > 50:
-            del self.status_list[4:-10]
-            self.add_status(StatusMonitor.EventTypes.ERROR,
-                            StatusMonitor.Categories.OMITTED_STATUSES,
-                            'Too many status msgs collected. Purged all but 4 oldest and 10 newest')
+        '''
+        Asks the background thread to send the collected messages now.
+        Returns immediately.
+        '''
+        with self._condition:
+            self._flush_requested = True
+            self._wakeup = True
+            self._condition.notify()
+
+    def time_to_next_send(self):
+        '''
+        Called with the condition held.
+        :return: Seconds until the messages are due to be sent, None if
+            nothing is waiting
+        '''
+        now = monotonic()
+        if self._failures:
+            return max(0, self._retry_time - now)
+        if self._oldest_pending_time is not None:
+            return max(0, self._oldest_pending_time + self.FLUSH_MAX_AGE - now)
+        return None
 
-        self.LOG.debug("Submitting collected events. Last: %s", self.status_list[-1])
-        data = self.status_list
-        self.LOG.debug('Headers: ', self.headers)
+    def should_send(self):
+        now = monotonic()
+        if self._retry_time > now or self.outbox.count() == 0:
+            return False
+        if self._flush_requested or self._failures:
+            return True
+        if self.outbox.count() >= self.FLUSH_SIZE:
+            return True
+        return self._oldest_pending_time is not None and now - self._oldest_pending_time >= self.FLUSH_MAX_AGE
+
+    def send_pending(self):
+        '''
+        Sends the playlist confirmation and the status messages in the
+        outbox in batches of BATCH_SIZE. Messages are removed from the outbox
+        only after the server has accepted them. Any error is retried with
+        backoff, so the sender thread never dies.
+        '''
         try:
-            response = requests.post(
-                self.status_url,
-                json=data,
-                headers=self.headers,
-                timeout=self.timeouts
-            )
-            if response.status_code == 201:
-                self.LOG.debug('Status list posted')
-                self.status_list = []
+            self.report_omitted()
+            sent = self.send_confirmation()
+            while sent:
+                batch = self.outbox.peek(self.STATUS, self.BATCH_SIZE)
+                if not batch:
+                    break
+                sent = self.send_statuses(batch)
         except requests.exceptions.RequestException as e:
             self.LOG.error('Could not submit collected events. Exception: {0}'.format(e.message))
+            sent = False
+        except Exception:
+            self.LOG.exception('Sending status messages failed')
+            sent = False
+        if sent:
+            self._failures = 0
+            self._retry_time = 0
+        else:
+            self.failed_sends += 1
+            self._failures += 1
+            backoff = min(self.MAX_BACKOFF, self.MIN_BACKOFF * 2 ** min(self._failures - 1, 16))
+            backoff *= random.uniform(0.5, 1)
+            self._retry_time = monotonic() + backoff
+            self.LOG.debug('Sending status messages again in %.0fs', backoff)
+
+    def report_omitted(self):
+        omitted = self.outbox.take_omitted()
+        if omitted:
+            self.add_status(StatusMonitor.EventTypes.ERROR,
+                            StatusMonitor.Categories.OMITTED_STATUSES,
+                            'Status buffer full, {0} oldest status msgs overwritten'.format(omitted))
+
+    def send_statuses(self, batch):
+        '''
+        :return: Whether the batch was accepted
+        '''
+        self.LOG.debug("Submitting %s collected events. Last: %s", len(batch), batch[-1][1])
+        ids = [message_id for message_id, _ in batch]
+        body = json.dumps([status for _, status in batch])
+        start_time = monotonic()
+        try:
+            response = self.post_json(body, self.compress)
+            if self.compress and response.status_code in self.COMPRESSION_REJECTED_CODES:
+                response = self.post_json(body, False)
+                if response.status_code == 201:
+                    self.LOG.info('Server does not accept compressed status messages')
+                    self.compress = False
+        except Exception:
+            self.outbox.release(ids)
+            raise
+        self.send_latency.record(monotonic() - start_time)
+        if response.status_code != 201:
+            self.outbox.release(ids)
+            return False
+        self.LOG.debug('Status list posted')
+        self.outbox.remove(ids)
+        self.batch_sizes.record(len(batch))
+        self.sent_messages += len(batch)
+        return True
+
+    def post_json(self, body, compress):
+        headers = {'Content-Type': 'application/json'}
+        self.uncompressed_bytes += len(body)
+        if compress:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+                gzip_file.write(body)
+            body = buf.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        self.sent_bytes += len(body)
+        return self.http_session.post(
+            self.status_url,
+            data=body,
+            headers=headers,
+            timeout=self.timeouts,
+            deadline=self.DEADLINE
+        )
+
+    def get_stats(self):
+        return {
+            'queue_depth': self.outbox.count(),
+            'sent_messages': self.sent_messages,
+            'failed_sends': self.failed_sends,
+            'batch_size': self.batch_sizes.get_stats(),
+            'send_latency': self.send_latency.get_stats(),
+            'uncompressed_bytes': self.uncompressed_bytes,
+            'sent_bytes': self.sent_bytes
+        }
 
     def add_status(self, event_type, event_category, event_description, event_time=None):
         if len(event_category) > 20:
@@ -86,36 +278,68 @@ class StatusMonitor(object):
             'type': event_type,
             'category': event_category,
             'time': event_time,
+            'last_time': event_time,
+            'count': 1,
             'description': event_description
         }
         self.LOG.debug('Appending status')
-        self.status_list.append(status_obj)
+        # Repeats of an unsent status only update its count and last time
+        key = u'{0}|{1}|{2}'.format(event_type, event_category, event_description)
+        self.outbox.append(self.STATUS, status_obj, key=key, merge=self.merge_statuses)
+        with self._condition:
+            if self._oldest_pending_time is None or self.outbox.count() >= self.FLUSH_SIZE:
+                if self._oldest_pending_time is None:
+                    self._oldest_pending_time = monotonic()
+                self._wakeup = True
+                self._condition.notify()
+
+    @staticmethod
+    def merge_statuses(unsent_status, status):
+        unsent_status['count'] += status['count']
+        unsent_status['last_time'] = status['last_time']
+        return unsent_status
 
     def confirm_new_playlist(self, playlist_id, playlist_update_time):
+        '''
+        Stores the confirmation in the outbox, replacing any older one, and
+        sends it with the next status messages.
+        '''
         if playlist_id is None:
             return
         data = {
             'confirmed_playlist': playlist_id,
             'update_time': playlist_update_time
         }
-        try:
-            response = requests.put(
-                self.confirm_pl_url,
-                json=data,
-                headers=self.headers,
-                timeout=self.timeouts
-            )
+        self.outbox.append(self.CONFIRMATION, data, replace=True)
+        self.submit_collected_events()
+
+    def send_confirmation(self):
+        '''
+        :return: False if the confirmation should be sent again later
+        '''
+        for message_id, data in self.outbox.peek(self.CONFIRMATION, 1):
+            try:
+                response = self.http_session.put(
+                    self.confirm_pl_url,
+                    json=data,
+                    timeout=self.timeouts,
+                    deadline=self.DEADLINE
+                )
+            except Exception:
+                self.outbox.release([message_id])
+                raise
             if response.status_code == 200:
                 self.LOG.debug('Playlist confirmed to server.')
-                return
-            if response.status_code == 428:
+            elif response.status_code == 428:
                 self.LOG.info('Server playlist was updated after download')
-                return
-
-            self.add_status(
-                StatusMonitor.EventTypes.ERROR,
-                'StatusMonitor',
-                'Could not confirm playlist use status: {0}'.format(response.status_code)
-            )
-        except requests.exceptions.RequestException as e:
-            self.LOG.error('Could not confirm playlist use. Exception: {0}'.format(e.message))
+            elif response.status_code >= 500:
+                self.outbox.release([message_id])
+                return False
+            else:
+                self.add_status(
+                    StatusMonitor.EventTypes.ERROR,
+                    'StatusMonitor',
+                    'Could not confirm playlist use status: {0}'.format(response.status_code)
+                )
+            self.outbox.remove([message_id])
+        return True
@@ -25,6 +25,20 @@ CONFIG_ITEMS = (
         'default': 'playlist/playlist.json',
         'is_path': True
     },
+    {
+        'section': 'Storage',
+        'item': 'media_manifest_file',
+        'description': 'Enter the filename of the media manifest (must not be in the media folder)',
+        'default': 'playlist/media_manifest.json',
+        'is_path': True
+    },
+    {
+        'section': 'Storage',
+        'item': 'media_index_file',
+        'description': 'Enter the filename of the media index (must not be in the media folder)',
+        'default': 'playlist/media_index.json',
+        'is_path': True
+    },
     {
         'section': 'Storage',
         'item': 'cleanup_threshold_mb',
@@ -39,6 +53,34 @@ CONFIG_ITEMS = (
         'default': '100',
         'is_path': False
     },
+    {
+        'section': 'Storage',
+        'item': 'eviction_policy',
+        'description': 'Enter the order in which unused media is removed (lru, lfu, gds or history)',
+        'default': 'lru',
+        'is_path': False
+    },
+    {
+        'section': 'Storage',
+        'item': 'eviction_history_playlists',
+        'description': 'Enter the number of latest playlists whose media the history policy keeps',
+        'default': '3',
+        'is_path': False
+    },
+    {
+        'section': 'Storage',
+        'item': 'outbox_file',
+        'description': 'Enter the filename of the outbox for unsent status messages (must not be in the media folder)',
+        'default': 'playlist/outbox.db',
+        'is_path': True
+    },
+    {
+        'section': 'Storage',
+        'item': 'outbox_max_records',
+        'description': 'Enter the maximum number of unsent status messages to keep',
+        'default': '1000',
+        'is_path': False
+    },
     {
         'section': 'Device',
         'item': 'device_id_file',
@@ -53,6 +95,48 @@ CONFIG_ITEMS = (
         'default': '60',
         'is_path': False
     },
+    {
+        'section': 'Client',
+        'item': 'playlist_max_poll_time',
+        'description': 'Enter the longest time between playlist fetches when backing off after errors (seconds)',
+        'default': '900',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'playlist_update_mode',
+        'description': 'Enter poll to fetch the playlist at fixed intervals or longpoll to let the server hold the request until the playlist changes.',
+        'default': 'poll',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'longpoll_wait_time',
+        'description': 'Enter how long the server may hold a long poll request (seconds)',
+        'default': '300',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'status_flush_size',
+        'description': 'Enter the number of status messages that are sent as soon as they are collected',
+        'default': '50',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'status_flush_max_age',
+        'description': 'Enter the maximum number of seconds a status message waits before it is sent',
+        'default': '60',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'status_compression',
+        'description': 'Enter the compression of status messages (gzip or none)',
+        'default': 'gzip',
+        'is_path': False
+    },
     {
         'section': 'Server',
         'item': 'server_url',
@@ -88,6 +172,13 @@ CONFIG_ITEMS = (
         'default': '30',
         'is_path': False
     },
+    {
+        'section': 'Client',
+        'item': 'playlist_total_timeout',
+        'description': 'Enter the maximum time in seconds a playlist request may take in total. (0 waits forever)',
+        'default': '120',
+        'is_path': False
+    },
     {
         'section': 'Client',
         'item': 'status_connection_timeout',
@@ -101,6 +192,90 @@ CONFIG_ITEMS = (
         'description': 'Enter time to wait for a single byte while posting a status message before giving up. (0 waits forever)',
         'default': '30',
         'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'status_total_timeout',
+        'description': 'Enter the maximum time in seconds sending status messages may take in total. (0 waits forever)',
+        'default': '120',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'download_workers',
+        'description': 'Enter the number of media files downloaded in parallel.',
+        'default': '3',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'download_total_timeout',
+        'description': 'Enter the maximum time in seconds a media download request may take before it is resumed later. (0 waits forever)',
+        'default': '0',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'task_workers',
+        'description': 'Enter the number of threads running playlist polls, playlist downloads and housekeeping tasks.',
+        'default': '3',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'revalidate_media',
+        'description': 'Enter 1 to check already downloaded media for changes on the server with a conditional request, 0 to trust the local copy (only if media URLs never change content).',
+        'default': '1',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'http_pool_size',
+        'description': 'Enter the number of HTTP connections kept alive per host.',
+        'default': '10',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'download_segments',
+        'description': 'Enter the number of byte ranges a large file is downloaded in concurrently (1 disables).',
+        'default': '4',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'segmented_download_min_mb',
+        'description': 'Enter the minimum file size in megabytes for downloading a file in segments.',
+        'default': '50',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'download_rate_kbps',
+        'description': 'Enter the maximum media download rate in kilobytes per second (0 is unlimited).',
+        'default': '0',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'download_burst_kb',
+        'description': 'Enter the number of kilobytes that may be downloaded at once above the download rate.',
+        'default': '256',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'download_rate_mode',
+        'description': 'Enter fixed to always use the download rate or adaptive to lower it when server requests slow down.',
+        'default': 'fixed',
+        'is_path': False
+    },
+    {
+        'section': 'Client',
+        'item': 'download_min_rate_kbps',
+        'description': 'Enter the lowest download rate in kilobytes per second used in adaptive mode.',
+        'default': '32',
+        'is_path': False
     }
 
 )
@@ -10,11 +10,21 @@ class AbstractViewer(object):
     @abstractmethod
     def display_content(self, content):
         '''
-        Makes the viewer display the given content
+        Makes the viewer display the given content, replacing the content
+        it is displaying, if any.
         :param content: An instance of Media to be displayed
         '''
         pass
 
+    def preload(self, content):
+        '''
+        Called while other content is still displayed with the content
+        this viewer displays next, so that it can be prepared in advance.
+        Preloading is optional and must not change what is displayed.
+        :param content: An instance of Media to be displayed next
+        '''
+        pass
+
     @abstractmethod
     def hide(self):
         '''
@@ -1,15 +1,19 @@
-import time
 import os
 import sh
+from threading import Event
 from media import Media
 import logging
 from abstract_viewer import AbstractViewer
+from timing import monotonic, TimingStats
 
 
 class Browser(AbstractViewer):
     '''
     A control class for the browser. Supports navigation to a web page and
-    displaying images.
+    displaying images. Images are shown on a background page, which also
+    preloads the next image or web page while the current image is shown.
+    The events uzbl prints are parsed and dispatched by name to handlers and
+    to threading.Event objects that can be waited on.
     '''
 
     # CONSTANTS
@@ -17,11 +21,19 @@ class Browser(AbstractViewer):
     IMG_BG_HTML_FILE = 'image_base.html'
     IMG_BACKGROUND_HTML = os.path.join(STATIC_FILE_PATH, IMG_BG_HTML_FILE)
     LOAD_FINISHED_EVENT = 'LOAD_FINISH'
+    LOAD_TIMEOUT = 10  # seconds
 
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.logger.debug('Initializing browser')
-        self._event_flags = {}
+        self._events = {self.LOAD_FINISHED_EVENT: Event()}
+        self._event_handlers = {self.LOAD_FINISHED_EVENT: self.load_finished}
+        self._showing_background = False
+        # The address being loaded and the time loading started
+        self._loading = None
+        # Load times of every address and all of them together
+        self.load_times = {}
+        self.load_time = TimingStats()
         self.start()
 
     def display_content(self, media):
@@ -30,30 +42,71 @@ class Browser(AbstractViewer):
         if not self.is_alive():
             self.start()
         if media.content_type == Media.WEB_PAGE:
-            self.navigate(media.content_uri)
+            self.navigate(media.display_uri)
         else:
-            self.show_image(media.content_uri)
+            self.show_image(media.display_uri)
+
+    def preload(self, media):
+        assert media.content_type in (Media.WEB_PAGE, Media.IMAGE)
+        # Only the background page can preload, and only once it has loaded
+        if not self._showing_background or not self._events[self.LOAD_FINISHED_EVENT].is_set():
+            return
+        self.logger.debug('Browser preloading content %s', media)
+        if media.content_type == Media.WEB_PAGE:
+            self.command('js', 'preloadPage("' + media.display_uri + '")')
+        else:
+            self.command('js', 'preloadImage("' + media.display_uri + '")')
 
     # Instead of shutting down the browser, displays a blank document
     def hide(self):
         self.logger.debug('Hiding browser')
         self.load_background()
 
-    # Sets flags indicating the state of the brower
+    @staticmethod
+    def parse_event(line):
+        '''
+        Parses a line printed by uzbl, e.g. "EVENT [1234] LOAD_FINISH 'uri'".
+        :return: The event name and its arguments or None if the line is not
+            an event
+        '''
+        parts = str(line).split(None, 3)
+        if len(parts) < 3 or parts[0] != 'EVENT':
+            return None
+        return parts[2], parts[3].strip() if len(parts) > 3 else ''
+
     def process_browser_events(self, line):
-        event = str(line)
-        for key in self._event_flags:
-            if key in event:
-                self.logger.debug('Setting event flag %s', key)
-                self._event_flags[key] = True
-
-    # Sleeps until a flag is set, used e.g. to wait for a page to load
-    def wait_for_event(self, event):
-        self.logger.debug('Browser waiting for event %s', event)
-        while True:
-            if event in self._event_flags and self._event_flags[event]:
-                return
-            time.sleep(0.1)
+        parsed = self.parse_event(line)
+        if parsed is None:
+            return
+        name, args = parsed
+        handler = self._event_handlers.get(name)
+        if handler is not None:
+            handler(args)
+        event = self._events.get(name)
+        if event is not None:
+            self.logger.debug('Setting event %s', name)
+            event.set()
+
+    def wait_for_event(self, name, timeout):
+        '''
+        Waits until the event is received, e.g. for a page to load.
+        :return: Whether the event was received before the timeout
+        '''
+        self.logger.debug('Browser waiting for event %s', name)
+        received = self._events[name].wait(timeout)
+        if not received:
+            self.logger.warning('Browser did not receive event %s in %ss', name, timeout)
+        return received
+
+    def load_finished(self, args):
+        if self._loading is None:
+            return
+        address, start_time = self._loading
+        self._loading = None
+        load_time = monotonic() - start_time
+        self.logger.debug('Loading %s took %.3fs', address, load_time)
+        self.load_times.setdefault(address, TimingStats()).record(load_time)
+        self.load_time.record(load_time)
 
     def start(self):
         self.logger.debug('Starting browser process')
@@ -82,14 +135,18 @@ class Browser(AbstractViewer):
 
     def navigate(self, address):
         self.logger.debug('Browser navigating to %s', address)
-        self._event_flags[self.LOAD_FINISHED_EVENT] = False
+        self._events[self.LOAD_FINISHED_EVENT].clear()
+        self._loading = (address, monotonic())
+        self._showing_background = address == Browser.IMG_BACKGROUND_HTML
         self.command('uri', address)
 
     def load_background(self):
         self.navigate(Browser.IMG_BACKGROUND_HTML)
 
     def show_image(self, img_uri):
-        self.wait_for_event(self.LOAD_FINISHED_EVENT)
+        if not self._showing_background:
+            self.load_background()
+        self.wait_for_event(self.LOAD_FINISHED_EVENT, self.LOAD_TIMEOUT)
         self.logger.debug('Browser beginning to show image %s', img_uri)
         self.command('js', 'loadImageFullScreen("' + img_uri + '")')
 
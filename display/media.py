@@ -1,8 +1,10 @@
 class Media(object):
     '''
     Represents an item to be displayed by the viewer. Consists
-    of a media type, the URI to the content and the time the media should
-    be displayed
+    of a media type, the URI to the content, the time the media should
+    be displayed and the path of the downloaded file, if any.
+    Media is immutable and hashable, so it can be shared between threads
+    and looked up in sets. Instances are compared by a key computed once.
     '''
 
     # Media types
@@ -12,10 +14,38 @@ class Media(object):
     VALID_TYPES = [VIDEO,IMAGE,WEB_PAGE]
     VALID_CONTENT_TYPES = {VIDEO:'video/*', IMAGE:'image/*'}
 
-    def __init__(self, content_type, content_uri, view_time):
-        self.content_type = content_type
-        self.content_uri = content_uri
-        self.view_time = view_time
+    __slots__ = ('content_type', 'content_uri', 'view_time', 'local_path', 'key', '_hash')
+
+    def __init__(self, content_type, content_uri, view_time, local_path=None):
+        '''
+        :param content_uri: The remote URI of the content
+        :param local_path: The path of the downloaded file, None for web pages
+            and content not downloaded yet
+        '''
+        key = (content_type, content_uri, view_time, local_path)
+        set_attribute = object.__setattr__
+        set_attribute(self, 'content_type', content_type)
+        set_attribute(self, 'content_uri', content_uri)
+        set_attribute(self, 'view_time', view_time)
+        set_attribute(self, 'local_path', local_path)
+        set_attribute(self, 'key', key)
+        set_attribute(self, '_hash', hash(key))
+
+    @property
+    def display_uri(self):
+        '''
+        The URI viewers display: the downloaded file if there is one
+        '''
+        return self.local_path or self.content_uri
+
+    def with_local_path(self, local_path):
+        return Media(self.content_type, self.content_uri, self.view_time, local_path)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Media is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Media is immutable')
 
     def __repr__(self):
         return self.__str__()
@@ -24,12 +54,18 @@ class Media(object):
         return (
             'ContentType=' + self.content_type +
             ',ContentUri=' + self.content_uri +
-            ',ViewTime=' + str(self.view_time)
+            ',ViewTime=' + str(self.view_time) +
+            ',LocalPath=' + str(self.local_path)
         )
 
     def __eq__(self, other):
         return \
             type(self) == type(other) and \
-            self.content_type == other.content_type and \
-            self.content_uri == other.content_uri and \
-            self.view_time == other.view_time
+            self._hash == other._hash and \
+            self.key == other.key
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return self._hash
@@ -0,0 +1,186 @@
+import time
+import sh
+import platform
+import logging
+from abc import ABCMeta, abstractmethod
+
+NON_PI_PLATFORMS = ('Ubuntu', 'LinuxMint')
+
+_distribution = None
+
+
+def linux_distribution():
+    '''
+    platform.linux_distribution() reads files under /etc, so the result is
+    cached.
+    '''
+    global _distribution
+    if _distribution is None:
+        _distribution = platform.linux_distribution()[0]
+    return _distribution
+
+
+class PlayerBackend(object):
+    '''
+    An interface for controlling a video player process.
+    '''
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def load(self, uri):
+        '''
+        Starts playing the video in a loop, replacing the current one.
+        '''
+        pass
+
+    @abstractmethod
+    def stop(self):
+        '''
+        Stops playing and removes the video from the screen.
+        '''
+        pass
+
+    @abstractmethod
+    def is_alive(self):
+        pass
+
+    @abstractmethod
+    def shutdown(self):
+        '''
+        Stops the player process for good.
+        '''
+        pass
+
+
+class VlcBackend(PlayerBackend):
+    '''
+    Keeps one VLC process running and controls it using its RC interface
+    through the standard input, so videos are changed without starting a
+    new process.
+    '''
+
+    LOG = logging.getLogger(__name__)
+    QUIT_TIMEOUT = 2  # seconds
+
+    def __init__(self):
+        self.process = None
+
+    def start(self):
+        self.LOG.debug('Starting VLC process')
+        self.process = sh.vlc(
+            '-I', 'rc', '--rc-fake-tty',
+            '--no-osd', '-f', '--no-interact', '--repeat',
+            '--mouse-hide-timeout', '--no-video-title-show',
+            '--video-on-top', _bg=True
+        )
+
+    def command(self, command):
+        self.LOG.debug('VLC handling command %s', command)
+        self.process.process.stdin.put(command + '\n')
+
+    def load(self, uri):
+        if not self.is_alive():
+            self.start()
+        self.command('clear')
+        self.command('add ' + uri)
+
+    def stop(self):
+        if self.is_alive():
+            self.command('stop')
+
+    def is_alive(self):
+        if self.process is None:
+            return False
+        else:
+            return self.process.process.exit_code is None
+
+    def shutdown(self):
+        if self.is_alive():
+            self.command('quit')
+            wait_for_exit(self, self.QUIT_TIMEOUT)
+        if self.is_alive():
+            self.process.process.kill()
+
+
+class OmxplayerBackend(PlayerBackend):
+    '''
+    omxplayer plays a single file, so a process is started for every video.
+    It is quit through its standard input, which releases the decoder
+    faster than killing it. killall is only used if it does not quit.
+    '''
+
+    LOG = logging.getLogger(__name__)
+    QUIT_TIMEOUT = 2  # seconds
+
+    def __init__(self):
+        self.process = None
+
+    def load(self, uri):
+        self.stop()
+        self.LOG.debug('Starting omxplayer for %s', uri)
+        self.process = sh.omxplayer('--no-osd', '-b', '--loop', uri, _bg=True)
+
+    def stop(self):
+        if not self.is_alive():
+            return
+        self.process.process.stdin.put('q')
+        wait_for_exit(self, self.QUIT_TIMEOUT)
+        if self.is_alive():
+            self.LOG.debug('omxplayer did not quit, killing it')
+            sh.killall('omxplayer.bin', _ok_code=[0, 1])
+
+    def is_alive(self):
+        if self.process is None:
+            return False
+        else:
+            return self.process.process.exit_code is None
+
+    def shutdown(self):
+        self.stop()
+
+
+class FakeBackend(PlayerBackend):
+    '''
+    Plays nothing, only records the loaded videos. For tests and machines
+    without a video player.
+    '''
+
+    def __init__(self):
+        self.loaded_uris = []
+        self.playing = None
+        self.running = True
+
+    def load(self, uri):
+        self.loaded_uris.append(uri)
+        self.playing = uri
+        self.running = True
+
+    def stop(self):
+        self.playing = None
+
+    def is_alive(self):
+        return self.running
+
+    def shutdown(self):
+        self.playing = None
+        self.running = False
+
+
+def wait_for_exit(backend, timeout):
+    deadline = time.time() + timeout
+    while backend.is_alive() and time.time() < deadline:
+        time.sleep(0.1)
+
+
+def create_player_backend(name=None):
+    '''
+    Creates the backend called name (vlc, omxplayer or fake). By default
+    omxplayer is used on the Raspberry Pi and VLC elsewhere.
+    '''
+    if name is None:
+        name = 'vlc' if linux_distribution() in NON_PI_PLATFORMS else 'omxplayer'
+    if name == 'fake':
+        return FakeBackend()
+    if name == 'vlc':
+        return VlcBackend()
+    return OmxplayerBackend()
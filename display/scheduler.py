@@ -1,46 +1,69 @@
+from collections import namedtuple
 from threading import Thread
-from threading import Lock
+from threading import Condition
 from viewer import Viewer
+from timing import monotonic, TimingStats
 import logging
 
 
+# An immutable version of the playlist. The generation grows by one for
+# every new playlist, members is the playlist as a set for lookups and
+# time is the monotonic() time it was published.
+PlaylistSnapshot = namedtuple('PlaylistSnapshot', ['generation', 'playlist', 'members', 'time'])
+
+
 class Scheduler(object):
     '''
     Schedules the content in the playlist to be displayed.
-    The scheduling occurs in its own thread. To ensure thread safety,
-    the play list should be modified using the
-    modify_playlist_atomically() method.
+    The scheduling occurs in its own thread. The playlist is never modified;
+    replace_playlist() publishes a new PlaylistSnapshot by replacing the
+    reference to it and wakes up the viewer. The scheduling thread detects
+    a new playlist by its generation and only then checks whether the
+    displayed content is still in it.
     '''
 
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.logger.debug('Initializing scheduler')
         self.viewer = Viewer()
-        self._playlist = []
-        self._playlist_lock = Lock()
+        self._snapshot = PlaylistSnapshot(0, (), frozenset(), monotonic())
+        self._playlist_changed = Condition()
+        # Generation of the playlist the displayed content was checked against
+        self._checked_generation = 0
         self.running = False
+        # Time from a playlist change to interrupting removed content
+        self.interrupt_latency = TimingStats()
 
     def start(self):
         self.logger.debug('Starting scheduling')
         self.running = True
 
         def is_interrupted_func(content):
-            return content not in self._playlist
+            snapshot = self._snapshot
+            if snapshot.generation == self._checked_generation:
+                return False
+            self._checked_generation = snapshot.generation
+            interrupted = content not in snapshot.members
+            if interrupted:
+                self.interrupt_latency.record(monotonic() - snapshot.time)
+            return interrupted
 
         def schedule_worker(scheduler):
             self.logger.debug('Scheduling thread started')
             index = 0
             while scheduler.running:
-                lock = scheduler._playlist_lock
-                lock.acquire()
-                try:
-                    playlist = scheduler._playlist
-                    content_index = index % len(playlist)
-                    content = playlist[content_index]
-                finally:
-                    lock.release()
+                snapshot = scheduler._snapshot
+                scheduler._checked_generation = snapshot.generation
+                playlist = snapshot.playlist
+                content = playlist[index % len(playlist)]
+                next_content = playlist[(index + 1) % len(playlist)]
                 self.logger.debug('Scheduler began displaying %s', content)
-                scheduler.viewer.display_content(content, is_interrupted_func)
+                scheduler.viewer.display_content(
+                    content,
+                    is_interrupted_func,
+                    scheduler._playlist_changed,
+                    next_content
+                )
                 index += 1
             scheduler.viewer.shutdown()
             self.logger.debug('Exiting scheduler worker thread')
@@ -53,14 +76,28 @@ class Scheduler(object):
         self.logger.debug('Scheduler shutdown called')
         self.running = False
         self.viewer.shutdown()
+        with self._playlist_changed:
+            self._playlist_changed.notify_all()
         self.logger.debug('Scheduler waiting for worker thread to stop')
         self.work_thread.join()
         self.logger.debug('Scheduler shut down complete')
 
-    def modify_playlist_atomically(self, modifier_function):
-        self.logger.debug('Modifying scheduler playlist atomically')
-        self._playlist_lock.acquire()
-        try:
-            modifier_function(self._playlist)
-        finally:
-            self._playlist_lock.release()
+    def replace_playlist(self, playlist):
+        self.logger.debug('Replacing scheduler playlist')
+        with self._playlist_changed:
+            playlist = tuple(playlist)
+            self._snapshot = PlaylistSnapshot(
+                self._snapshot.generation + 1,
+                playlist,
+                frozenset(playlist),
+                monotonic()
+            )
+            self._playlist_changed.notify_all()
+
+    def get_timing_stats(self):
+        return {
+            'drift': self.viewer.drift.get_stats(),
+            'gap': self.viewer.gap.get_stats(),
+            'page_load': self.viewer.page_load_stats(),
+            'interrupt_latency': self.interrupt_latency.get_stats()
+        }
@@ -0,0 +1,55 @@
+import ctypes
+import ctypes.util
+import time
+
+CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+try:
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = (ctypes.c_int, ctypes.POINTER(_Timespec))
+    _clock_gettime.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _clock_gettime = None
+
+
+def monotonic():
+    '''
+    Seconds from an arbitrary point in time. Unlike time.time() this is
+    not affected by changes of the system clock, e.g. by NTP after boot.
+    Falls back to time.time() on platforms without clock_gettime.
+    '''
+    if _clock_gettime is None:
+        return time.time()
+    timespec = _Timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+        return time.time()
+    return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+
+class TimingStats(object):
+    '''
+    Collects the count, mean and maximum of measured durations.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def get_stats(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max
+        }
@@ -1,51 +1,56 @@
-import sh
-import platform
+from threading import Thread
 from media import Media
 import logging
 from abstract_viewer import AbstractViewer
+from player_backends import create_player_backend
 
 
 class VideoPlayer(AbstractViewer):
     '''
-    A control class for the video player.
+    A control class for the video player. The player process is controlled
+    by a PlayerBackend, chosen by the platform unless one is given.
     '''
 
-    NON_PI_PLATFORMS = ('Ubuntu', 'LinuxMint')
+    PRELOAD_BYTES = 16 * 1024 * 1024
+    PRELOAD_READ_SIZE = 1024 * 1024
 
-    def __init__(self):
+    def __init__(self, backend=None):
         self.logger = logging.getLogger(__name__)
         self.logger.debug('Initializing VideoPlayer')
-        self.process = None
+        self.backend = backend or create_player_backend()
 
     def display_content(self, content):
         assert content.content_type == Media.VIDEO
         self.logger.debug('VideoPlayer receiving content %s', content)
-        uri = content.content_uri
-        if platform.linux_distribution()[0] in self.NON_PI_PLATFORMS:
-            self.process = sh.vlc(
-                '--no-osd', '-f', '--no-interact', '--repeat',
-                '--mouse-hide-timeout', '--no-video-title-show',
-                '--video-on-top', uri, _bg=True
-            )
-        else:
-            self.process = sh.omxplayer(
-                '--no-osd', '-b', '--loop', uri, _bg=True)
-
-    # Cannot really hide player, must shut down
+        self.backend.load(content.display_uri)
+
+    def preload(self, content):
+        '''
+        Reads the beginning of the video into the page cache in the
+        background, so the next player starts without waiting for the disk.
+        '''
+        assert content.content_type == Media.VIDEO
+
+        def read_head(filepath):
+            try:
+                with open(filepath, 'rb') as f:
+                    remaining = self.PRELOAD_BYTES
+                    while remaining > 0 and f.read(self.PRELOAD_READ_SIZE):
+                        remaining -= self.PRELOAD_READ_SIZE
+            except IOError, e:
+                self.logger.debug('Could not preload %s: %s', filepath, e)
+
+        preload_thread = Thread(target=read_head, args=(content.display_uri,))
+        preload_thread.daemon = True
+        preload_thread.start()
+
     def hide(self):
         self.logger.debug('VideoPlayer hide called')
-        self.shutdown()
+        self.backend.stop()
 
     def shutdown(self):
         self.logger.debug('VideoPlayer shutdown called')
-        if self.is_alive():
-            if platform.linux_distribution()[0] in self.NON_PI_PLATFORMS:
-                sh.pkill('vlc')
-            else:
-                sh.killall('omxplayer.bin', _ok_code=[0, 1])
+        self.backend.shutdown()
 
     def is_alive(self):
-        if self.process is None:
-            return False
-        else:
-            return self.process.process.exit_code is None
+        return self.backend.is_alive()
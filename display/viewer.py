@@ -1,7 +1,7 @@
-import time
 from media import Media
 from browser import Browser
 from video_player import VideoPlayer
+from timing import monotonic, TimingStats
 import logging
 
 
@@ -12,37 +12,96 @@ class Viewer(object):
     type. The displaying is performed in a separate thread, so
     shutdown() must be called before killing the program to avoid
     errors upon program termination.
+    Content is displayed until a deadline on the monotonic clock. While
+    waiting, the viewer sleeps on a condition signaled when the playlist
+    changes, so removed content is interrupted immediately.
+    The next content is preloaded while the current one is displayed. If the
+    same viewer displays the next content, it is not hidden in between.
+    The browser and video player are only started when needed.
     '''
 
-    DISPLAY_TIME_GRANULARITY = 1  # seconds
-    BROWSER = Browser()
-    PLAYER = VideoPlayer()
+    KEEP_ALIVE_INTERVAL = 1  # seconds
 
-    VIEWERS = {
-        Media.IMAGE: BROWSER,
-        Media.WEB_PAGE: BROWSER,
-        Media.VIDEO: PLAYER
+    # Viewers are created when content of their type is first displayed
+    VIEWER_CLASSES = {
+        Media.IMAGE: Browser,
+        Media.WEB_PAGE: Browser,
+        Media.VIDEO: VideoPlayer
     }
 
-    def display_content(self, content, is_interrupted_func):
+    def __init__(self):
         self.logger = logging.getLogger(__name__)
+        self.running = False
+        # How much later than its view time displaying content ended
+        self.drift = TimingStats()
+        # Time between the end of displaying content and displaying the next
+        self.gap = TimingStats()
+        self._previous_end_time = None
+        # Viewer instances by class
+        self._viewers = {}
+        # When the first content was displayed
+        self.first_display_time = None
+
+    def display_content(self, content, is_interrupted_func, playlist_changed, next_content=None):
+        '''
+        Displays the content for its view time or until interrupted.
+        :param is_interrupted_func: Tells whether the content was removed from
+            the playlist. Called while holding playlist_changed.
+        :param playlist_changed: A Condition notified when the playlist changes
+        :param next_content: The content to be displayed next, if known
+        '''
         self.logger.debug('Viewer received content %s', content)
-        viewer = self.VIEWERS[content.content_type]
+        viewer = self.get_viewer(content.content_type)
 
-        displayed_time = 0
         viewer.display_content(content)
+        if self.first_display_time is None:
+            self.first_display_time = monotonic()
+        if self._previous_end_time is not None:
+            self.gap.record(monotonic() - self._previous_end_time)
+        deadline = monotonic() + content.view_time
         self.running = True
+        next_viewer = None
+        if next_content is not None:
+            next_viewer = self.get_viewer(next_content.content_type)
+            self.preload(next_viewer, next_content)
+        interrupted = False
 
-        while self.running and displayed_time < content.view_time:
-            if is_interrupted_func(content):
-                break
-            time.sleep(self.DISPLAY_TIME_GRANULARITY)
-            displayed_time += self.DISPLAY_TIME_GRANULARITY
+        while self.running:
+            with playlist_changed:
+                interrupted = is_interrupted_func(content)
+                remaining_time = deadline - monotonic()
+                if interrupted or remaining_time <= 0:
+                    break
+                playlist_changed.wait(min(remaining_time, self.KEEP_ALIVE_INTERVAL))
             self.keep_alive(viewer, content)
 
-        viewer.hide()
+        if not interrupted and self.running:
+            self.drift.record(max(0.0, monotonic() - deadline))
+        # The next content replaces this one directly in the same viewer
+        if interrupted or next_viewer is not viewer:
+            viewer.hide()
+        self._previous_end_time = monotonic()
         self.logger.debug('Viewer finished displaying content %s', content)
 
+    def get_viewer(self, content_type):
+        viewer_class = self.VIEWER_CLASSES[content_type]
+        if viewer_class not in self._viewers:
+            self.logger.debug('Creating viewer %s', viewer_class.__name__)
+            self._viewers[viewer_class] = viewer_class()
+        return self._viewers[viewer_class]
+
+    def page_load_stats(self):
+        browser = self._viewers.get(Browser)
+        if browser is None:
+            return TimingStats().get_stats()
+        return browser.load_time.get_stats()
+
+    def preload(self, viewer, content):
+        try:
+            viewer.preload(content)
+        except Exception, e:
+            self.logger.error('Could not preload content %s: %s', content, e)
+
     def keep_alive(self, viewer, content):
         if not viewer.is_alive():
             self.logger.debug('Resurrecting viewer for content %s', content)
@@ -51,6 +110,6 @@ class Viewer(object):
     def shutdown(self):
         self.logger.debug('Viewer shutdown requested')
         self.running = False
-        self.BROWSER.shutdown()
-        self.PLAYER.shutdown()
+        for viewer in self._viewers.values():
+            viewer.shutdown()
         self.logger.debug('Viewer shutdown complete')
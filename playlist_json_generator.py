@@ -1,6 +1,6 @@
 import json
 from display.media import Media
-from client.playlist_manager import PlaylistManager
+from client.playlist_parser import PlaylistJsonParser
 
 QUIT_STRING = '\\q'
 playlist = []
@@ -43,9 +43,9 @@ def read_media():
         print 'Content type must be one of: %s, %s, %s' % valid_types
         return None
     media = {
-        PlaylistManager.SCHEDULE_TIME_STRING: display_time,
-        PlaylistManager.SCHEDULE_URI_STRING: content_url,
-        PlaylistManager.SCHEDULE_TYPE_STRING: content_type
+        PlaylistJsonParser.SCHEDULE_TIME_STRING: display_time,
+        PlaylistJsonParser.SCHEDULE_URI_STRING: content_url,
+        PlaylistJsonParser.SCHEDULE_TYPE_STRING: content_type
     }
     return media
 
@@ -0,0 +1,166 @@
+'''
+A small local stand-in for the backend server, for trying out the client
+without the real server.
+
+Serves a playlist JSON file created with playlist_json_generator.py. The
+playlist is considered updated whenever the file is modified. Supports
+conditional requests (ETag) and long polling with the 'wait' query
+parameter. Status messages (also gzip compressed) and playlist
+confirmations are accepted and logged.
+
+The playlist and status paths are read from the client properties, so the
+stand-in answers where the client sends its requests.
+Set server_url in client.properties to http://localhost:<port>/
+'''
+
+import BaseHTTPServer
+import ConfigParser
+import SocketServer
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from cStringIO import StringIO
+from optparse import OptionParser
+from urlparse import urlparse, parse_qs
+from client.config_utils import get_option
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'client/client.properties')
+DEFAULT_PLAYLIST_PATH = '/api/device/playlist'
+DEFAULT_STATUS_PATH = '/api/device/status'
+WAIT_STEP = 0.5  # seconds
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, playlist_filepath, playlist_path, status_path):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandInRequestHandler)
+        self.playlist_filepath = playlist_filepath
+        self.playlist_path = playlist_path.rstrip('/')
+        self.status_path = status_path.rstrip('/')
+
+    def read_playlist(self):
+        '''
+        Returns the playlist response body and its ETag
+        '''
+        with open(self.playlist_filepath, 'r') as playlist_file:
+            media_schedule = playlist_file.read()
+        updated = int(os.path.getmtime(self.playlist_filepath))
+        body = json.dumps({
+            'id': 1,
+            'updated': updated,
+            'media_url': 'http://%s:%s/' % self.server_address,
+            'media_schedule_json': media_schedule
+        })
+        return body, '"%s"' % hashlib.md5(body).hexdigest()
+
+
+class StandInRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    LOG = logging.getLogger(__name__)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != self.server.playlist_path:
+            self.send_error(404)
+            return
+        wait = float(parse_qs(url.query).get('wait', ['0'])[0])
+        deadline = time.time() + wait
+        body, etag = self.server.read_playlist()
+        while etag == self.headers.get('If-None-Match') and time.time() < deadline:
+            time.sleep(WAIT_STEP)
+            body, etag = self.server.read_playlist()
+        if etag == self.headers.get('If-None-Match'):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != self.server.status_path:
+            self.send_error(404)
+            return
+        self.LOG.info('Status: %s', self.read_body())
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PUT(self):
+        if urlparse(self.path).path.rstrip('/') != self.server.playlist_path:
+            self.send_error(404)
+            return
+        self.LOG.info('Playlist confirmed: %s', self.read_body())
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        return body
+
+    def log_message(self, format, *args):
+        self.LOG.debug('%s - %s', self.address_string(), format % args)
+
+
+def read_server_paths(config_path):
+    '''
+    :return: A tuple (playlist_path, status_path) from the Server section
+        of the client properties, defaults if the file does not exist
+    '''
+    config = ConfigParser.ConfigParser()
+    config.read(config_path)
+    if not config.has_section('Server'):
+        return DEFAULT_PLAYLIST_PATH, DEFAULT_STATUS_PATH
+    return (get_option(config, 'Server', 'playlist_server_path', DEFAULT_PLAYLIST_PATH),
+            get_option(config, 'Server', 'status_server_path', DEFAULT_STATUS_PATH))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] playlist.json')
+    parser.add_option(
+        '-p',
+        '--port',
+        dest='port',
+        type='int',
+        default=8000,
+        help='Port to listen on'
+    )
+    parser.add_option(
+        '-c',
+        '--config',
+        dest='config',
+        default=CONFIG_PATH,
+        help='Client properties file to read the server paths from'
+    )
+    parser.add_option('--playlist-path', dest='playlist_path', help='Overrides playlist_server_path')
+    parser.add_option('--status-path', dest='status_path', help='Overrides status_server_path')
+    parser.add_option('-v', '--verbose', action='store_true', dest='verbose', help='Log every request')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('The playlist JSON file is required')
+    logging.basicConfig(
+        level=logging.DEBUG if options.verbose else logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    playlist_path, status_path = read_server_paths(options.config)
+    playlist_path = options.playlist_path or playlist_path
+    status_path = options.status_path or status_path
+    server = StandInServer(('localhost', options.port), args[0], playlist_path, status_path)
+    StandInRequestHandler.LOG.info('Serving %s on port %s, playlist at %s, status at %s',
+                                   args[0], options.port, playlist_path, status_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -3,7 +3,9 @@ import os
 from optparse import OptionParser
 import subprocess
 import ConfigParser
-from client.client import Client
+from client.startup_timer import StartupTimer
+from client.playlist_parser import PlaylistJsonParser
+from display.scheduler import Scheduler
 
 START_PATH = os.path.dirname(os.path.realpath(__file__))
 START_SHELL_SCRIPT_NAME = 'start.sh'
@@ -77,12 +79,39 @@ LOGGING_CONFIG = {
 }
 
 
+def show_stored_playlist(config):
+    '''
+    Starts displaying the stored playlist, if there is one, so that content
+    is shown before the network parts of the client are imported and set up.
+    :return: The Scheduler for the client to use
+    '''
+    scheduler = Scheduler()
+    playlist_parser = PlaylistJsonParser(config.get('Storage', 'playlist_file'))
+    try:
+        playlist = playlist_parser.get_stored_playlist()
+    except:
+        logging.getLogger(__name__).info('No locally stored playlist')
+        return scheduler
+    if playlist:
+        scheduler.replace_playlist(playlist)
+        scheduler.start()
+    return scheduler
+
+
 def run():
+    startup_timer = StartupTimer()
     config = ConfigParser.ConfigParser()
     with open(CONFIG_PATH) as config_fp:
         config.readfp(config_fp)
     logging.config.dictConfig(LOGGING_CONFIG)
-    client = Client(config)
+    startup_timer.mark('config')
+    scheduler = show_stored_playlist(config)
+    startup_timer.mark('stored playlist')
+    # Imports requests and the rest of the network stack
+    from client.client import Client
+    startup_timer.mark('imports')
+    client = Client(config, scheduler, startup_timer)
+    startup_timer.mark('client')
     client.start()
 
 